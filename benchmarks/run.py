@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Benchmark django_session_jwt.
+
+Measures create_jwt(), verify_jwt() and a full request / response cycle
+through SessionMiddleware for each signing algorithm, payload size and session
+engine. Results are written as JSON lines (one object per measurement) so
+they can be compared between releases:
+
+    python benchmarks/run.py > before.jsonl
+    python benchmarks/run.py --filter RS256 --number 200
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+from os.path import dirname, abspath
+from os.path import join as pathjoin
+from unittest import mock
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_session_jwt.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+import jwt  # noqa: E402
+
+from django.conf import settings  # noqa: E402
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.contrib.auth.middleware import AuthenticationMiddleware  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+from django.test.client import RequestFactory  # noqa: E402
+from django.test.utils import override_settings, setup_test_environment  # noqa: E402
+
+from django_session_jwt.middleware import session  # noqa: E402
+from django_session_jwt.version import __version__  # noqa: E402
+
+
+KEYS = pathjoin(ROOT, 'keys')
+ALGORITHMS = {
+    'HS256': settings.SECRET_KEY,
+    'RS256': (pathjoin(KEYS, 'rsa'), pathjoin(KEYS, 'rsa.pub')),
+    'ES256': (pathjoin(KEYS, 'ec'), pathjoin(KEYS, 'ec.pub')),
+    'EdDSA': (pathjoin(KEYS, 'ed25519'), pathjoin(KEYS, 'ed25519.pub')),
+}
+# (FIELDS, CALLABLE) for each payload, None keeps the configured value.
+PAYLOADS = {
+    # Fields configured in django_session_jwt.settings.
+    'small': (None, None),
+    # Fifty extra claims from CALLABLE.
+    'large': (None, lambda user: dict(('claim%02d' % i, 'value %d' % i) for i in range(50))),
+    # Fifty fields read from the user.
+    'large_fields': ([
+        (attrname, '%s%02d' % (attrname[:2], i), '%s%02d' % (attrname, i))
+        for i in range(10)
+        for attrname in ('id', 'username', 'email', 'first_name', 'is_staff')
+    ], None),
+}
+ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+
+
+def read_view(request):
+    request.session.get('jwt')
+    return HttpResponse('OK')
+
+
+def write_view(request):
+    request.session['counter'] = request.session.get('counter', 0) + 1
+    return HttpResponse('OK')
+
+
+def measure(func, number, repeat):
+    "Return timings in microseconds per call."
+    times = timeit.Timer(func).repeat(repeat=repeat, number=number)
+    times = sorted(t / number * 1e6 for t in times)
+    return {
+        'min_us': round(times[0], 3),
+        'median_us': round(times[len(times) // 2], 3),
+        'max_us': round(times[-1], 3),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def configure(algo, payload):
+    "Patch the middleware module for the given algorithm and payload."
+    key, pubkey, algo = session._parse_key(ALGORITHMS[algo])
+    patches = [
+        mock.patch.object(session, 'KEY', key),
+        mock.patch.object(session, 'PUBKEY', pubkey),
+        mock.patch.object(session, 'ALGO', algo),
+    ]
+    fields, callable = PAYLOADS[payload]
+    if fields:
+        fields = session._parse_fields(fields)
+        patches.extend([
+            mock.patch.object(session, 'FIELDS', fields),
+            mock.patch.object(session, 'FIELD_GETTERS', session._compile_fields(fields)),
+        ])
+    if callable:
+        patches.append(mock.patch.object(session, 'CALLABLE', callable))
+    return patches
+
+
+def bench_tokens(user, number, repeat):
+    token = session.create_jwt(user, 'x' * 32, session.EXPIRES)
+    yield 'create_jwt', {'size': len(token)}, measure(
+        lambda: session.create_jwt(user, 'x' * 32, session.EXPIRES), number, repeat)
+    yield 'verify_jwt', {'size': len(token)}, measure(
+        lambda: session.verify_jwt(token), number, repeat)
+
+
+def bench_middleware(user, engine, number, repeat):
+    with override_settings(SESSION_ENGINE=ENGINES[engine]):
+        store = session.SessionMiddleware(lambda r: None).SessionStore()
+        store['_auth_user_id'] = str(user.pk)
+        store['_auth_user_backend'] = settings.AUTHENTICATION_BACKENDS[0]
+        store['_auth_user_hash'] = user.get_session_auth_hash()
+        store.save()
+        token = session.create_jwt(user, store.session_key, session.EXPIRES)
+
+        factory = RequestFactory()
+        for name, view in (('read', read_view), ('write', write_view)):
+            middleware = session.SessionMiddleware(AuthenticationMiddleware(view))
+
+            def cycle():
+                request = factory.get('/')
+                request.COOKIES[settings.SESSION_COOKIE_NAME] = token
+                middleware(request)
+
+            yield 'middleware_%s' % name, {}, measure(cycle, number, repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--number', type=int, default=500,
+                        help='calls per timing run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timing runs per measurement')
+    parser.add_argument('--filter', default='',
+                        help='only run measurements whose labels contain this')
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+    user = get_user_model().objects.create_user('john', 'john@domain.com', 'password')
+
+    def emit(record):
+        args.output.write(json.dumps(record, sort_keys=True) + '\n')
+        args.output.flush()
+
+    emit({
+        'name': 'meta',
+        'version': __version__,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'pyjwt': jwt.__version__,
+    })
+
+    for algo in ALGORITHMS:
+        for payload in PAYLOADS:
+            patches = configure(algo, payload)
+            for patch in patches:
+                patch.start()
+            # Derived from FIELDS.
+            session._user_select_related.cache_clear()
+            try:
+                labels = {'algo': algo, 'payload': payload}
+                results = list(bench_tokens(user, args.number, args.repeat)) \
+                    if args.filter in '%s %s token' % (algo, payload) else []
+                for engine in ENGINES:
+                    if args.filter not in '%s %s %s' % (algo, payload, engine):
+                        continue
+                    for name, extra, timing in bench_middleware(
+                            user, engine, args.number, args.repeat):
+                        extra['engine'] = engine
+                        results.append((name, extra, timing))
+
+                for name, extra, timing in results:
+                    record = dict(labels, name=name, **extra)
+                    record.update(timing)
+                    emit(record)
+
+            finally:
+                for patch in patches:
+                    patch.stop()
+                session._user_select_related.cache_clear()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,3 +3,4 @@ from django.apps import AppConfig
 
 class DjangoSessionJwtConfig(AppConfig):
     name = 'django_session_jwt'
+    default_auto_field = 'django.db.models.AutoField'
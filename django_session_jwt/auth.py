@@ -0,0 +1,87 @@
+"""
+Authenticate requests from the verified JWT instead of the session.
+
+Replace django.contrib.auth.middleware.AuthenticationMiddleware with
+django_session_jwt.auth.JWTAuthenticationMiddleware and request.user becomes a
+user model instance built from the JWT fields. The user row is only fetched
+when a view uses a field that is not in the JWT.
+
+Logging out, deactivating a user or changing their password is not noticed
+before the JWT is reissued (when the session is saved or the JWT refreshed):
+JWTs already issued stay valid until they expire.
+"""
+from django.contrib import auth
+from django.contrib.auth import get_user_model
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.utils.functional import SimpleLazyObject
+
+from django_session_jwt.middleware import session
+
+
+def _user_attrs(fields):
+    "Map user attribute names to the long names of the fields holding them."
+    return dict(
+        (attrname, lname) for attrname, _, lname in fields if '.' not in attrname)
+
+
+USER_ATTRS = _user_attrs(session.FIELDS)
+
+
+def user_from_jwt(fields):
+    """
+    Return a user model instance built from verified JWT fields.
+
+    User fields configured in DJANGO_SESSION_JWT["FIELDS"] are read from the
+    JWT, the others are deferred: each is loaded from the database (one query)
+    when first used.
+    """
+    User = get_user_model()
+    opts = User._meta
+    values = {opts.pk.attname: opts.pk.to_python(fields['user_id'])}
+    for field in opts.concrete_fields:
+        lname = USER_ATTRS.get(field.attname)
+        if lname is not None and lname in fields and field.attname not in values:
+            values[field.attname] = field.to_python(fields[lname])
+
+    names = [field.attname for field in opts.concrete_fields if field.attname in values]
+    user = User.from_db(
+        session.user_queryset().db, names, [values[name] for name in names])
+    # Not checked against the database, SessionMiddleware does that when it
+    # signs a new JWT for the user.
+    user.from_jwt = True
+    return user
+
+
+def _jwt_user(request):
+    fields = getattr(getattr(request, 'session', None), 'jwt', None)
+    if not fields or fields.get('user_id') is None:
+        return None
+    return user_from_jwt(fields)
+
+
+def get_user(request):
+    "Return the user from the JWT, or fall back to contrib.auth."
+    user = _jwt_user(request)
+    if user is None:
+        return auth.get_user(request)
+    return user
+
+
+async def aget_user(request):
+    user = _jwt_user(request)
+    if user is None:
+        return await auth.aget_user(request)
+    return user
+
+
+class JWTAuthenticationMiddleware(AuthenticationMiddleware):
+    """
+    Set request.user from the session JWT, falling back to contrib.auth.
+    """
+
+    def process_request(self, request):
+        super(JWTAuthenticationMiddleware, self).process_request(request)
+        request.user = SimpleLazyObject(lambda: get_user(request))
+        if hasattr(request, 'auser'):
+            # Django 5.0+
+            request.auser = lambda: aget_user(request)
@@ -0,0 +1,149 @@
+"""
+Two-tier session engine for use with django_session_jwt.middleware.
+
+    SESSION_ENGINE = 'django_session_jwt.backends.tiered'
+
+Sessions are stored in a shared backend (TIERED_BACKEND, any contrib.sessions
+engine) and copied to a per-process LRU cache. Every save writes through to
+the shared backend and stamps the session with a new random version, which
+the middleware signs into the JWT as the "sv" claim. A request whose JWT
+names the version held locally is served from memory; any other version
+means the session was changed elsewhere and the shared backend is read.
+
+A session deleted in one process may still be served by others, to holders of
+its last JWT, until their copy expires after TIERED_CACHE_TTL seconds. With a
+REVOCATION_STORE, deleting a session also revokes its key so that such JWTs
+are rejected by every process.
+"""
+import time
+
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import CreateError, SessionBase, VALID_KEY_CHARS
+from django.utils.crypto import get_random_string
+
+from django_session_jwt.cache import LRUCache
+from django_session_jwt.middleware import session
+
+
+DJANGO_SESSION_JWT = getattr(settings, 'DJANGO_SESSION_JWT', {})
+TIERED_BACKEND = DJANGO_SESSION_JWT.get(
+    'TIERED_BACKEND', 'django.contrib.sessions.backends.db')
+TIERED_CACHE_SIZE = DJANGO_SESSION_JWT.get('TIERED_CACHE_SIZE', 10000)
+TIERED_CACHE_TTL = DJANGO_SESSION_JWT.get('TIERED_CACHE_TTL', 300)
+# JWT claim carrying the session version.
+VERSION_FIELD = session.VERSION_FIELD
+# Key of the version in the data saved to the shared backend.
+VERSION_KEY = '_tiered_version'
+
+
+class SessionStore(SessionBase):
+    """
+    Session store with a per-process tier in front of TIERED_BACKEND.
+    """
+
+    # {session key: (version, data)}, shared by the stores of this process.
+    local = LRUCache(TIERED_CACHE_SIZE)
+
+    def __init__(self, session_key=None):
+        super(SessionStore, self).__init__(session_key)
+        # Version of the data loaded or saved, and the one the JWT names.
+        self.version = None
+        self.jwt_version = None
+
+    @classmethod
+    def get_shared_store_class(cls):
+        return import_module(TIERED_BACKEND).SessionStore
+
+    def _shared(self, session_key):
+        return self.get_shared_store_class()(session_key)
+
+    def set_jwt_claims(self, claims):
+        "Called by the middleware with the verified claims of the JWT."
+        self.jwt_version = claims.get(VERSION_FIELD)
+
+    def jwt_claims(self):
+        "Return the claims to add to the next JWT for this session."
+        if self.version is None:
+            return {}
+        return {VERSION_FIELD: self.version}
+
+    def _keep(self, session_key, version, data):
+        # Serialized, views may change nested values without saving.
+        self.local.set(
+            session_key, (version, self.serializer().dumps(data)),
+            time.time() + TIERED_CACHE_TTL)
+
+    def load(self):
+        session_key = self.session_key
+        if session_key is not None and self.jwt_version is not None:
+            entry = self.local.get(session_key)
+            if entry is not None and entry[0] == self.jwt_version:
+                self.version = entry[0]
+                return self.serializer().loads(entry[1])
+
+        shared = self._shared(session_key)
+        data = dict(shared.load())
+        if shared.session_key is None:
+            # Missing or expired in the shared backend.
+            self._session_key = None
+            self.local.pop(session_key)
+            return {}
+
+        self.version = data.pop(VERSION_KEY, None)
+        self._keep(session_key, self.version, data)
+        return data
+
+    def exists(self, session_key):
+        return self.local.get(session_key) is not None or \
+            self._shared(session_key).exists(session_key)
+
+    def create(self):
+        while True:
+            self._session_key = self._get_new_session_key()
+            try:
+                self.save(must_create=True)
+
+            except CreateError:
+                # Key wasn't unique. Try again.
+                continue
+            self.modified = True
+            return
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+
+        data = self._get_session(no_load=must_create)
+        version = self.version
+        if version is None or self.modified or must_create:
+            # Random rather than counted, processes saving the same version at
+            # the same time must not stamp different data alike.
+            version = get_random_string(12, VALID_KEY_CHARS)
+
+        shared = self._shared(self.session_key)
+        shared._session_cache = dict(data, **{VERSION_KEY: version})
+        shared.save(must_create=must_create)
+
+        self.version = version
+        self._keep(self.session_key, version, data)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+
+        self.local.pop(session_key)
+        self._shared(session_key).delete(session_key)
+        if session.REVOCATIONS is not None and \
+           session.REVOCATION_CLAIM == session.SESSION_FIELD:
+            # Other processes may still hold a copy, reject its JWTs everywhere.
+            expires = None if session.EXPIRES is None else \
+                int(time.time()) + session.EXPIRES
+            session.REVOCATIONS.revoke(session_key, expires)
+
+    @classmethod
+    def clear_expired(cls):
+        cls.get_shared_store_class().clear_expired()
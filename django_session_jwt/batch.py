@@ -0,0 +1,104 @@
+"""
+Chunked, optionally parallel, JWT signing and verification.
+
+Used by create_jwt_many() and verify_jwt_many(). Chunks are signed or
+verified in the processes of a concurrent.futures executor. Nothing here
+imports Django, so worker processes start quickly. Prepared keys can not be
+pickled, they are passed as PEM and prepared once per worker.
+"""
+from collections import deque
+from itertools import islice
+
+import jwt
+from jwt.algorithms import get_default_algorithms
+from jwt.exceptions import InvalidTokenError
+
+from django_session_jwt.compact import CompactJWT, SUPPORTED as COMPACT_SUPPORTED
+
+
+ALGORITHMS = get_default_algorithms()
+_JWT = CompactJWT() if COMPACT_SUPPORTED else jwt
+_KEYS = {}
+
+
+def portable_key(key):
+    "Return key in a form that can be sent to another process."
+    try:
+        from cryptography.hazmat.primitives import serialization
+
+    except ImportError:
+        return key
+
+    if hasattr(key, 'private_bytes'):
+        return key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption())
+    if hasattr(key, 'public_bytes'):
+        return key.public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo)
+    return key
+
+
+def _prepare_key(key, algo):
+    try:
+        return _KEYS[key, algo]
+
+    except KeyError:
+        prepared = _KEYS[key, algo] = ALGORITHMS[algo].prepare_key(key)
+        return prepared
+
+
+def encode_chunk(items):
+    "Sign [(claims, key, algo, headers, compact), ...], returning the JWTs."
+    return [
+        (_JWT if compact else jwt).encode(
+            claims, _prepare_key(key, algo), algorithm=algo, headers=headers)
+        for claims, key, algo, headers, compact in items
+    ]
+
+
+def decode_chunk(items):
+    "Verify [(blob, key, algo), ...], returning the claims or None for each."
+    results = []
+    for blob, key, algo in items:
+        try:
+            results.append(_JWT.decode(blob, _prepare_key(key, algo), algorithms=[algo]))
+
+        except InvalidTokenError:
+            results.append(None)
+
+    return results
+
+
+def chunks(iterable, size):
+    "Yield lists of up to size items from iterable."
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def map_chunks(func, chunks, executor=None):
+    """
+    Yield func(chunk) for each chunk, in order.
+
+    With an executor, a few chunks per worker are in flight at any time, so
+    memory use does not grow with the input.
+    """
+    if executor is None:
+        for chunk in chunks:
+            yield func(chunk)
+        return
+
+    window = 2 * (getattr(executor, '_max_workers', None) or 1)
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(func, chunk))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,145 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Bounded, thread-safe LRU mapping whose entries optionally expire.
+
+    Entries are stored with an absolute expiry timestamp (or None). Expired
+    entries are dropped when they are looked up; when the cache is full the
+    least recently used entry is evicted.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires=None):
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, (default, None))[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        "Return hit / miss counters and current size."
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+class SharedCache(object):
+    """
+    Digests of verified JWTs, shared by the processes of a host through a
+    memory-mapped file.
+
+    The file holds a fixed number of slots. Each digest has one slot (a newer
+    digest simply replaces the one there), stored with the JWT expiry and a
+    check value, so readers need no lock: a slot read while another process
+    writes it fails the check and counts as a miss.
+
+    Anyone able to write the file can make JWTs pass verification, it is
+    created readable and writable by its owner only, and an existing file is
+    rejected (ValueError) unless it has the same owner and mode. Symlinks are
+    not followed. The slot count of an existing file is kept, remove the file
+    to resize it.
+    """
+
+    SLOT = struct.Struct('>32sqQ')
+    NO_EXPIRY = 2 ** 63 - 1
+
+    def __init__(self, path, slots=65536):
+        # Refuse symlinks, and files others could have written to.
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            stat = os.fstat(fd)
+            if stat.st_uid != os.geteuid() or stat.st_mode & 0o077:
+                raise ValueError(
+                    '%s must be owned by this user and not accessible by '
+                    'others' % path)
+
+            size = stat.st_size
+            if not size or size % self.SLOT.size:
+                size = slots * self.SLOT.size
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+
+        finally:
+            os.close(fd)
+
+        self.path = path
+        self.slots = size // self.SLOT.size
+
+    @staticmethod
+    def digest(prefix, blob):
+        "Return the digest of blob under prefix, a fingerprint of its key."
+        return hashlib.sha256(prefix + blob.encode('utf-8')).digest()
+
+    def _offset(self, digest):
+        return int.from_bytes(digest[-8:], 'big') % self.slots * self.SLOT.size
+
+    def _check(self, digest, expires):
+        return int.from_bytes(digest[:8], 'big') ^ expires
+
+    def get(self, digest):
+        "Return True if digest is cached and has not expired."
+        stored, expires, check = self.SLOT.unpack_from(self._map, self._offset(digest))
+        return stored == digest and check == self._check(digest, expires) and \
+            expires > time.time()
+
+    def set(self, digest, expires=None):
+        expires = self.NO_EXPIRY if expires is None else max(int(expires), 0)
+        self.SLOT.pack_into(
+            self._map, self._offset(digest), digest, expires,
+            self._check(digest, expires))
+
+    def clear(self):
+        self._map[:] = bytes(len(self._map))
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,97 @@
+from collections.abc import Mapping
+
+
+class Claims(Mapping):
+    """
+    Read-only view of verified JWT claims.
+
+    Claims are stored once, as signed (by short name). Long names are resolved
+    through index, a {long name: short name} dict built from FIELDS, so both
+    fields['id'] and fields['user_id'] work without duplicating values.
+    Iterating yields the short names followed by the long names that resolve.
+
+    Names in hidden are left out, exclude() returns such a view without
+    copying the claims.
+    """
+
+    __slots__ = ('_claims', '_index', '_hidden')
+
+    def __init__(self, claims, index=None, hidden=frozenset()):
+        self._claims = claims
+        self._index = index or {}
+        self._hidden = hidden
+
+    @property
+    def raw(self):
+        "The claims as signed, including hidden names. Do not modify."
+        return self._claims
+
+    def exclude(self, *names):
+        return Claims(self._claims, self._index, self._hidden.union(names))
+
+    def __getitem__(self, name):
+        if name in self._hidden:
+            raise KeyError(name)
+        try:
+            return self._claims[name]
+
+        except KeyError:
+            sname = self._index.get(name)
+            if sname is None or sname in self._hidden:
+                raise
+            return self._claims[sname]
+
+    def __iter__(self):
+        claims, hidden = self._claims, self._hidden
+        for name in claims:
+            if name not in hidden:
+                yield name
+        for lname, sname in self._index.items():
+            if sname in claims and sname not in hidden and lname not in claims:
+                yield lname
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'Claims(%r)' % dict(self)
+
+
+def parse_fields(fields, session_field='sk'):
+    """
+    Normalize field definitions to (attrname, short name, long name) tuples.
+
+    Each field is an attribute name or a 1, 2 or 3-tuple. Raises ValueError
+    for invalid definitions.
+    """
+    parsed = []
+    for field in fields:
+        if not isinstance(field, tuple):
+            field = (field, field, field)
+        elif len(field) == 1:  # (attrname)
+            field = (field[0], field[0], field[0])
+        elif len(field) == 2:  # (attrname, sname)
+            field = (field[0], field[1], field[1])
+
+        if len(field) != 3:
+            raise ValueError('FIELDS should be a list of 3-tuples.')
+
+        # The session key has its own claim.
+        if field[1] == session_field:
+            raise ValueError(
+                'Short name "%s" is reserved for the session field.' % session_field)
+
+        parsed.append(field)
+
+    if len(set(sname for _, sname, _ in parsed)) != len(parsed):
+        raise ValueError('FIELDS short names are not unique')
+
+    if len(set(lname for _, _, lname in parsed)) != len(parsed):
+        raise ValueError('FIELDS long names are not unique')
+
+    return parsed
+
+
+def fields_index(fields):
+    "Return the {long name: short name} index Claims uses for parsed fields."
+    return dict((lname, sname) for _, sname, lname in fields if lname != sname)
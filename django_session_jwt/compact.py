@@ -0,0 +1,77 @@
+"""
+Deflate compressed JWT payloads.
+
+With DJANGO_SESSION_JWT["COMPACT"] enabled, the JSON claims are compressed
+with raw DEFLATE (RFC 1951) before signing and the token carries the
+"zip": "DEF" header, the compression header registered by RFC 7516. A payload
+is only compressed when that makes it smaller, so small tokens are unchanged.
+
+Compressed tokens are still signed JWS, but federated services must inflate
+the payload themselves (or use this module) before reading the claims.
+"""
+import zlib
+
+from jwt.api_jwt import PyJWT
+from jwt.exceptions import DecodeError
+
+
+ZIP_HEADER = 'zip'
+ZIP_DEFLATE = 'DEF'
+
+# PyJWT releases before the payload hooks cannot be extended this way.
+SUPPORTED = hasattr(PyJWT, '_encode_payload') and hasattr(PyJWT, '_decode_payload')
+
+# Refuse to inflate payloads beyond any sensible cookie size.
+MAX_PAYLOAD = 64 * 1024
+
+
+def deflate(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def inflate(data, limit=MAX_PAYLOAD):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    try:
+        inflated = decompressor.decompress(data, limit)
+
+    except zlib.error as e:
+        raise DecodeError('Invalid compressed payload: %s' % e)
+
+    if decompressor.unconsumed_tail:
+        raise DecodeError('Compressed payload is too large')
+
+    return inflated
+
+
+class CompactJWT(PyJWT):
+    """
+    PyJWT that compresses payloads when encoding, if compress is set, and
+    inflates "zip": "DEF" payloads when decoding.
+    """
+
+    def __init__(self, compress=True, options=None):
+        super(CompactJWT, self).__init__(options)
+        self.compress = compress
+
+    def _encode_payload(self, payload, headers=None, json_encoder=None):
+        data = super(CompactJWT, self)._encode_payload(
+            payload, headers=headers, json_encoder=json_encoder)
+        if not self.compress or headers is None:
+            # The header can only be set through the caller's headers.
+            return data
+
+        compressed = deflate(data)
+        if len(compressed) >= len(data):
+            return data
+
+        headers[ZIP_HEADER] = ZIP_DEFLATE
+        return compressed
+
+    def _decode_payload(self, decoded):
+        zip_ = decoded['header'].get(ZIP_HEADER)
+        if zip_ is not None:
+            if zip_ != ZIP_DEFLATE:
+                raise DecodeError('Unsupported compression: %s' % zip_)
+            decoded = dict(decoded, payload=inflate(decoded['payload']))
+        return super(CompactJWT, self)._decode_payload(decoded)
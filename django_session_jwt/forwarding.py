@@ -0,0 +1,67 @@
+"""
+Claims forwarded by a trusted proxy that already verified the JWT.
+
+The proxy sends the verified claims in a header next to the session cookie:
+
+    base64url(claims JSON) "." base64url(HMAC-SHA256(key, token "." payload))
+
+where token is the JWT from the cookie, payload is the first part of the
+header and base64url omits padding. Binding the HMAC to the token means the
+claims are only accepted together with the JWT they were read from.
+"""
+import hmac
+import ipaddress
+import json
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import sha256
+
+
+def _b64encode(data):
+    return urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _signature(key, token, payload):
+    message = ('%s.%s' % (token, payload)).encode('utf-8')
+    return _b64encode(hmac.new(key, message, sha256).digest())
+
+
+def sign(key, token, claims):
+    "Return the header value forwarding claims verified from token."
+    payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+    return '%s.%s' % (payload, _signature(key, token, payload))
+
+
+def unsign(key, token, value):
+    "Return the claims forwarded for token, or None if value is not valid."
+    payload, _, signature = value.rpartition('.')
+    if not payload or not hmac.compare_digest(
+            signature, _signature(key, token, payload)):
+        return None
+
+    try:
+        claims = json.loads(_b64decode(payload).decode('utf-8'))
+
+    except ValueError:
+        return None
+
+    return claims if isinstance(claims, dict) else None
+
+
+def parse_networks(proxies):
+    "Return a tuple of networks for a list of addresses and CIDR ranges."
+    return tuple(ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+
+def trusted(networks, address):
+    try:
+        address = ipaddress.ip_address(address)
+
+    except ValueError:
+        return False
+
+    return any(address in network for network in networks)
@@ -0,0 +1,180 @@
+"""
+Load keys for signing and verifying JWTs.
+
+Nothing here imports Django, see django_session_jwt.verifier.
+"""
+import time
+
+from os.path import exists as pathexists
+
+from jwt.algorithms import get_default_algorithms
+from jwt.exceptions import InvalidKeyError
+
+
+class KeyConfigurationError(ValueError):
+    "Raised for keys that can not be loaded or used."
+
+
+ALGORITHMS = get_default_algorithms()
+EC_ALGORITHMS = {
+    'secp256r1': 'ES256',
+    'secp384r1': 'ES384',
+    'secp521r1': 'ES512',
+}
+
+
+def prepare_key(key, algo):
+    "Parse raw key material once into the object PyJWT uses to sign / verify."
+    try:
+        algorithm = ALGORITHMS[algo]
+
+    except KeyError:
+        # Misspelled, or RS / ES / EdDSA without cryptography installed.
+        raise KeyConfigurationError('Unsupported algorithm: %s' % algo)
+
+    try:
+        return algorithm.prepare_key(key)
+
+    except (InvalidKeyError, TypeError, ValueError) as e:
+        raise KeyConfigurationError('Invalid %s key: %s' % (algo, e))
+
+
+def detect_algo(key, public=False):
+    "Determine the signing algorithm from PEM (or SSH public) key material."
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed448, ed25519, rsa
+
+    key = key.encode('utf-8') if isinstance(key, str) else key
+    try:
+        if not public:
+            key = serialization.load_pem_private_key(key, password=None)
+        elif key.startswith(b'ssh-'):
+            key = serialization.load_ssh_public_key(key)
+        else:
+            key = serialization.load_pem_public_key(key)
+
+    except (TypeError, ValueError) as e:
+        raise KeyConfigurationError('Could not load key: %s' % e)
+
+    if isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        return 'RS256'
+
+    if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey,
+                        ed448.Ed448PrivateKey, ed448.Ed448PublicKey)):
+        return 'EdDSA'
+
+    if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)):
+        try:
+            return EC_ALGORITHMS[key.curve.name]
+
+        except KeyError:
+            pass
+
+    raise KeyConfigurationError('Unsupported key type %s' % type(key).__name__)
+
+
+def parse_key(key, algo=None):
+    def _load_key(k):
+        if k is not None and pathexists(k):
+            k = open(k, 'rb').read()
+        return k
+
+    if isinstance(key, tuple):
+        # Key pair, (private, public[, algo]). Private may be None for keys
+        # that are only used for verification.
+        if len(key) == 3:
+            algo = key[2]
+        private, public = _load_key(key[0]), _load_key(key[1])
+        if algo is None:
+            algo = detect_algo(private) if private is not None \
+                else detect_algo(public, public=True)
+        private = None if private is None else prepare_key(private, algo)
+        return private, prepare_key(public, algo), algo
+
+    algo = algo or 'HS256'
+    key = prepare_key(_load_key(key), algo)
+    return key, key, algo
+
+
+class KeyRing(object):
+    """
+    Signing and verification keys indexed by key id (the JWT "kid" header).
+
+    Each key accepts the same values as parse_key(). Tokens are
+    signed with the key designated by signing_kid and verified with the key
+    named in their header, so rotating keys never requires trying each one.
+    Keys can be added, removed and designated at runtime, or reloaded from a
+    callable. An unknown kid triggers a reload at most once per
+    refresh_interval seconds.
+    """
+
+    def __init__(self, keys=None, signing_kid=None, loader=None,
+                 refresh_interval=60):
+        self._keys = {}
+        self._signing_kid = None
+        self._loaded = 0
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.version = 0
+        for kid, key in (keys or {}).items():
+            self.add(kid, key)
+        if loader:
+            self.reload()
+        if signing_kid is not None:
+            self.set_signing_key(signing_kid)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, kid):
+        return kid in self._keys
+
+    def add(self, kid, key):
+        self._keys[kid] = parse_key(key)
+        self.version += 1
+
+    def remove(self, kid):
+        if kid == self._signing_kid:
+            raise ValueError('Cannot remove the signing key "%s"' % kid)
+        self._keys.pop(kid, None)
+        self.version += 1
+
+    def set_signing_key(self, kid):
+        if kid not in self._keys:
+            raise KeyConfigurationError('Unknown signing key id "%s"' % kid)
+        if self._keys[kid][0] is None:
+            raise KeyConfigurationError('Key id "%s" has no private key' % kid)
+        self._signing_kid = kid
+
+    def reload(self):
+        "Add or replace keys with those returned by the loader."
+        self._loaded = time.time()
+        keys = dict(self._keys)
+        keys.update((kid, parse_key(key)) for kid, key in self.loader().items())
+        self._keys = keys
+        self.version += 1
+
+    @property
+    def signing(self):
+        "Return (kid, key, algo) for signing, or None if not configured."
+        if self._signing_kid is None:
+            return None
+        key, _, algo = self._keys[self._signing_kid]
+        return self._signing_kid, key, algo
+
+    def get(self, kid):
+        "Return (pubkey, algo) for verifying tokens signed with kid."
+        try:
+            _, pubkey, algo = self._keys[kid]
+
+        except KeyError:
+            if not self.loader or \
+               time.time() - self._loaded < self.refresh_interval:
+                return None
+            # Unknown kid, pick up keys added since startup.
+            self.reload()
+            if kid not in self._keys:
+                return None
+            _, pubkey, algo = self._keys[kid]
+
+        return pubkey, algo
@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import sys
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.backends.base import VALID_KEY_CHARS
+from django.core.management.base import BaseCommand
+from django.utils.crypto import get_random_string
+
+from django_session_jwt import batch
+from django_session_jwt.middleware import session
+
+
+class Command(BaseCommand):
+    help = (
+        'Sign or verify JWTs in bulk. "mint" signs a JWT with a new session key '
+        'for each user id read (or every user), "verify" prints the claims of '
+        'each JWT read as JSON, "reissue" signs a new JWT for the user and '
+        'session of each JWT read. Output is one line per input line.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('mint', 'verify', 'reissue'))
+        parser.add_argument(
+            '--input', type=argparse.FileType('r'),
+            help='File with one user id (mint) or JWT per line, - for stdin. '
+                 'mint uses every user when omitted. For verify and reissue, '
+                 'the JWT is the last field of each line, so the output of mint '
+                 'can be used as is.')
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count(),
+            help='Worker processes for signing and verifying, 1 to disable.')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument(
+            '--expires', type=int, default=session.EXPIRES,
+            help='Lifetime of new JWTs in seconds.')
+
+    def handle(self, action, **options):
+        processes = options['processes'] or 1
+        executor = ProcessPoolExecutor(processes) if processes > 1 else None
+        try:
+            getattr(self, action)(executor, **options)
+
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _lines(self, input):
+        for line in input or sys.stdin:
+            line = line.strip()
+            if line:
+                yield line
+
+    def _tokens(self, input):
+        # JWTs contain no whitespace, mint writes "<user id> <JWT>".
+        for line in self._lines(input):
+            yield line.split()[-1]
+
+    def _users(self, input, chunk_size):
+        "Yield (user id, user or None), fetching users chunk_size at a time."
+        if input is None:
+            for user in session.user_queryset().order_by('pk').iterator():
+                yield user.pk, user
+            return
+
+        pk = get_user_model()._meta.pk
+        for chunk in batch.chunks(self._lines(input), chunk_size):
+            chunk = [pk.to_python(user_id) for user_id in chunk]
+            users = session.user_queryset().in_bulk(chunk)
+            for user_id in chunk:
+                yield user_id, users.get(user_id)
+
+    def mint(self, executor, input, chunk_size, expires, **options):
+        ids = deque()
+
+        def pairs():
+            for user_id, user in self._users(input, chunk_size):
+                ids.append(user_id)
+                yield user, get_random_string(32, VALID_KEY_CHARS)
+
+        blobs = session.create_jwt_many(pairs(), expires, executor, chunk_size)
+        for blob in blobs:
+            self.stdout.write('%s %s' % (ids.popleft(), blob or ''))
+
+    def verify(self, executor, input, chunk_size, **options):
+        for fields in session.verify_jwt_many(self._tokens(input), executor, chunk_size):
+            self.stdout.write(json.dumps(dict(fields), sort_keys=True))
+
+    def reissue(self, executor, input, chunk_size, expires, **options):
+        blobs = session.reissue_jwt_many(self._tokens(input), expires, executor, chunk_size)
+        for blob in blobs:
+            self.stdout.write(blob or '')
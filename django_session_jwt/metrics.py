@@ -0,0 +1,91 @@
+"""
+Metrics hooks for DJANGO_SESSION_JWT["METRICS"].
+
+The middleware reports each event by calling the configured hook as
+hook(event, duration), where duration is the elapsed time in seconds for
+timed stages and None for plain counters. Events are:
+
+- verify.ok, verify.expired, verify.invalid: JWT decoding (timed).
+- verify.cached: JWT served from the verified token cache.
+- verify.shared: JWT signature verified by another process (timed).
+- verify.revoked: JWT was valid but revoked (timed unless cached).
+- forwarded, forwarded.expired: claims accepted from a trusted proxy.
+- encode: JWT signing (timed).
+- user_lookup: user fetched to build a new JWT (timed).
+- session_save: contrib.sessions response handling, including saving the
+  session (timed).
+- reissue: a new JWT was sent to the client.
+- refresh: the JWT was reissued because it was due for refresh.
+- reuse: the session was saved but the unchanged JWT was sent again.
+
+Any callable will do. The adapters below forward events to statsd or
+Prometheus. Create an instance in your project and point METRICS at it:
+
+    # myproject/metrics.py
+    from django_session_jwt.metrics import StatsdMetrics
+    metrics = StatsdMetrics('localhost', 8125)
+
+    # settings.py
+    DJANGO_SESSION_JWT = {'METRICS': 'myproject.metrics.metrics', ...}
+"""
+import socket
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+class StatsdMetrics(object):
+    """
+    Send events to a statsd server over UDP.
+
+    Timed events are sent as timers (milliseconds), others as counters.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='django_session_jwt'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, event, duration=None):
+        if duration is None:
+            data = '%s.%s:1|c' % (self.prefix, event)
+        else:
+            data = '%s.%s:%.3f|ms' % (self.prefix, event, duration * 1000)
+
+        try:
+            self._socket.sendto(data.encode('utf-8'), self.address)
+
+        except (OSError, socket.error):
+            # Metrics must never break a request.
+            pass
+
+
+class PrometheusMetrics(object):
+    """
+    Record events with prometheus_client.
+
+    Exposes <namespace>_events_total (counter) and
+    <namespace>_duration_seconds (histogram), both labeled by event.
+    """
+
+    def __init__(self, namespace='django_session_jwt', registry=None):
+        try:
+            import prometheus_client
+
+        except ImportError:
+            raise ImproperlyConfigured(
+                'PrometheusMetrics requires the prometheus_client package.')
+
+        kwargs = {'namespace': namespace}
+        if registry is not None:
+            kwargs['registry'] = registry
+
+        self.events = prometheus_client.Counter(
+            'events_total', 'django_session_jwt events.', ['event'], **kwargs)
+        self.durations = prometheus_client.Histogram(
+            'duration_seconds', 'django_session_jwt stage durations.',
+            ['event'], **kwargs)
+
+    def __call__(self, event, duration=None):
+        self.events.labels(event).inc()
+        if duration is not None:
+            self.durations.labels(event).observe(duration)
@@ -1 +1,7 @@
 from .session import SessionMiddleware, convert_cookie, verify_jwt
+
+try:
+    from .asynchronous import AsyncSessionMiddleware
+except ImportError:
+    # asgiref is only available with Django 3.0+.
+    pass
@@ -0,0 +1,134 @@
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from django_session_jwt.middleware import session
+from django_session_jwt.middleware.session import (
+    SessionMiddleware, _session_fields, verify_jwt,
+)
+
+
+EXECUTOR_WORKERS = session.DJANGO_SESSION_JWT.get('EXECUTOR_WORKERS', 0)
+
+
+class AsyncSessionMiddleware(SessionMiddleware):
+    """
+    Native async SessionMiddleware for ASGI deployments (Django 3.1+).
+
+    The user lookup uses the async ORM when available (Django 4.1+). JWT
+    verification and signing run in a bounded thread pool when
+    DJANGO_SESSION_JWT["EXECUTOR_WORKERS"] is set, so CPU-heavy asymmetric
+    crypto does not stall the event loop. The session backend is only used
+    from a worker thread when the session has to be saved.
+    """
+
+    sync_capable = False
+    async_capable = True
+
+    executor = None
+
+    def __init__(self, get_response):
+        super(AsyncSessionMiddleware, self).__init__(get_response)
+        if EXECUTOR_WORKERS and AsyncSessionMiddleware.executor is None:
+            # Shared by all instances, to bound crypto threads per process.
+            AsyncSessionMiddleware.executor = ThreadPoolExecutor(
+                EXECUTOR_WORKERS, thread_name_prefix='django_session_jwt')
+
+    async def _offload(self, func, *args):
+        "Run func in the executor, or a thread if there is no executor."
+        if self.executor is None:
+            return await sync_to_async(func)(*args)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args))
+
+    async def __call__(self, request):
+        if self._bypass(request):
+            return await self.get_response(request)
+
+        session_jwt = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        fields = None
+        if session.TRUSTED_PROXIES:
+            fields = session.verify_forwarded(request, session_jwt)
+        if fields is None and self.executor is None:
+            fields = verify_jwt(session_jwt)
+        elif fields is None:
+            fields = await self._offload(verify_jwt, session_jwt)
+        self._set_session(request, fields, session_jwt)
+
+        response = await self.get_response(request)
+        return await self.aprocess_response(request, response)
+
+    async def _alookup_user(self, fields):
+        User = get_user_model()
+        if not hasattr(User.objects, 'aget'):
+            return await sync_to_async(self._lookup_user)(fields)
+
+        user_id = fields.get('user_id')
+        if user_id is None:
+            return None
+
+        start = session.METRICS and session.timer()
+        try:
+            return await session.user_queryset().aget(id=user_id)
+
+        except User.DoesNotExist:
+            return None
+
+        finally:
+            if session.METRICS:
+                session._emit('user_lookup', start)
+
+    def _authenticated_user(self, request):
+        # request.user is missing without AuthenticationMiddleware.
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return user
+        return None
+
+    async def _aget_user(self, request, fields):
+        auser = getattr(request, 'auser', None)
+        if auser is not None:
+            user = await auser()
+        else:
+            user = await sync_to_async(self._authenticated_user)(request)
+
+        if user is None or not user.is_authenticated or \
+           getattr(user, 'from_jwt', False):
+            # The user is unauthenticated, or taken from the JWT without
+            # checking the database. Try to determine the user by the session
+            # JWT.
+            user = await self._alookup_user(fields)
+            if user is not None:
+                user = await sync_to_async(self._check_user)(request, user)
+
+        return user
+
+    async def aprocess_response(self, request, response):
+        fields = _session_fields(request)
+        refresh = self._refresh_due(request, fields)
+
+        modified = getattr(getattr(request, 'session', None), 'modified', False)
+        if modified or settings.SESSION_SAVE_EVERY_REQUEST:
+            await sync_to_async(self._save_session)(request, response)
+        else:
+            # Nothing to save, this is only cookie and header handling.
+            self._save_session(request, response)
+
+        if self._reissue_due(request, response, refresh):
+            user = await self._aget_user(request, fields)
+            # Building the claims can query the database, only signing is
+            # offloaded to the executor.
+            claims = await sync_to_async(self._reissue_claims)(
+                request, response, user, refresh)
+            if claims is not None:
+                blob = await self._offload(session._encode, claims)
+                self._set_jwt(response, blob, refresh)
+
+        return response
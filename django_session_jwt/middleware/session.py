@@ -1,77 +1,87 @@
+import json
 import logging
+import re
+import secrets
 import time
 
-from datetime import datetime, timedelta
+from collections import deque
+
+from timeit import default_timer as timer
 
-from os.path import exists as pathexists
+from datetime import datetime, timedelta
 
 import jwt
-from jwt.exceptions import DecodeError, ExpiredSignatureError
+from jwt.exceptions import InvalidTokenError
 
+from functools import lru_cache
 from importlib import import_module
+from operator import attrgetter
 
 from django.conf import settings
-from django.contrib.auth import get_user_model
+from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.base import CreateError, VALID_KEY_CHARS
 from django.contrib.sessions.middleware import SessionMiddleware as BaseSessionMiddleware
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured, ValidationError
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.utils.crypto import constant_time_compare, get_random_string
 
+from django_session_jwt import batch, compact, forwarding
+from django_session_jwt.cache import LRUCache, SharedCache
+from django_session_jwt.claims import Claims, fields_index, parse_fields
+from django_session_jwt.keys import KeyConfigurationError, KeyRing, parse_key
+from django_session_jwt.refresh import RefreshPolicy
+from django_session_jwt.revocation import RevocationList
+from django_session_jwt.verifier import Verifier
 
-def _parse_key(key):
-    def _load_key(k):
-        if pathexists(k):
-            k = open(k, 'rb').read()
-        return k
 
-    if isinstance(key, tuple):
-        # Key pair.
-        return _load_key(key[0]), _load_key(key[1]), 'RS256'
+def _parse_key(key, algo=None):
+    try:
+        return parse_key(key, algo)
 
-    key = _load_key(key)
-    return key, key, 'HS256'
+    except KeyConfigurationError as e:
+        raise ImproperlyConfigured(str(e))
 
 
 def _parse_fields(fields):
     "Parse and validate field definitions."
-    snames, lnames = [], []
+    try:
+        return parse_fields(fields, SESSION_FIELD)
 
-    for i, field in enumerate(fields):
-        # Transform field in 3-tuple.
-        if isinstance(field, tuple):
-            if len(field) == 2:  # (attrname, sname)
-                field = (field[0], field[1], field[1])
+    except ValueError as e:
+        raise ImproperlyConfigured('DJANGO_SESSION_JWT["FIELDS"] is invalid: %s' % e)
 
-            elif len(field) == 1:  # (attrname)
-                field = (field[0], field[0], field[0])
 
-        else:  # attrname
-            field = (field, field, field)
+def _compile_fields(fields):
+    "Compile field definitions into (getter, sname, attrname) tuples."
+    return [(attrgetter(attrname), sname, attrname) for attrname, sname, _ in fields]
 
-        # Collect all snames and lnames for uniqueness check.
-        snames.append(field[1])
-        lnames.append(field[2])
 
-        # Validate that "sk" is not used, we use that for the session key.
-        if field[1] == SESSION_FIELD:
-            raise ImproperlyConfigured(
-                'Short name "%s" is reserved for session field. Use '
-                'DJANGO_SESSION_JWT["SESSION_FIELD"] to specify another '
-                'value.' % SESSION_FIELD)
+def _select_related(fields, model):
+    """
+    Return the select_related() lookups needed to read the dotted attribute
+    names in fields from an instance of model with a single query.
+    """
+    related = set()
+    for attrname, _, _ in fields:
+        opts, path = model._meta, []
+        for name in attrname.split('.')[:-1]:
+            try:
+                field = opts.get_field(name)
 
-        if len(field) != 3:
-            raise ImproperlyConfigured(
-                'DJANGO_SESSION_JWT["FIELDS"] should be a list of 3-tuples.')
+            except FieldDoesNotExist:
+                break
 
-        fields[i] = field
+            # Only single-valued relations can be joined.
+            if not (field.many_to_one or field.one_to_one):
+                break
 
-    if len(snames) != len(set(snames)):
-        raise ImproperlyConfigured(
-            'DJANGO_SESSION_JWT["FIELDS"] short names are not unique')
+            path.append(name)
+            opts = field.related_model._meta
 
-    if len(lnames) != len(set(lnames)):
-        raise ImproperlyConfigured(
-            'DJANGO_SESSION_JWT["FIELDS"] long names are not unique')
+        if path:
+            related.add('__'.join(path))
 
-    return fields
+    return sorted(related)
 
 
 def _parse_callable(f):
@@ -84,12 +94,134 @@ def _parse_callable(f):
     return getattr(m, f_name)
 
 
+def _parse_compact(enabled):
+    if enabled and not compact.SUPPORTED:
+        raise ImproperlyConfigured(
+            'DJANGO_SESSION_JWT["COMPACT"] requires a PyJWT release with '
+            'payload encoding hooks, please upgrade PyJWT.')
+    return bool(enabled)
+
+
+def _parse_revocations(store, claim, interval):
+    if claim not in (SESSION_FIELD, 'jti'):
+        raise ImproperlyConfigured(
+            'DJANGO_SESSION_JWT["REVOCATION_CLAIM"] should be "%s" or "jti"'
+            % SESSION_FIELD)
+    if not store:
+        return None
+
+    store = _parse_callable(store)
+    if isinstance(store, type):
+        store = store()
+    return RevocationList(store, interval)
+
+
+def _parse_trusted(proxies, key):
+    if not proxies:
+        return ()
+    if not key:
+        raise ImproperlyConfigured(
+            'DJANGO_SESSION_JWT["TRUSTED_KEY"] is required with TRUSTED_PROXIES')
+
+    try:
+        return forwarding.parse_networks(proxies)
+
+    except ValueError as e:
+        raise ImproperlyConfigured(
+            'DJANGO_SESSION_JWT["TRUSTED_PROXIES"] is invalid: %s' % e)
+
+
+def _parse_bypass(prefixes, patterns):
+    "Compile path prefixes and regular expressions into a single matcher."
+    if not prefixes and not patterns:
+        return None
+
+    prefixes = tuple(prefixes or ())
+    try:
+        pattern = re.compile('|'.join('(?:%s)' % p for p in patterns)) \
+            if patterns else None
+
+    except re.error as e:
+        raise ImproperlyConfigured(
+            'DJANGO_SESSION_JWT["BYPASS_PATTERNS"] is invalid: %s' % e)
+
+    if pattern is None:
+        return lambda path: path.startswith(prefixes)
+    return lambda path: path.startswith(prefixes) or pattern.match(path) is not None
+
+
+def _parse_shared_cache(path, slots):
+    if not path:
+        return None
+
+    try:
+        return SharedCache(path, slots)
+
+    except (OSError, ValueError) as e:
+        raise ImproperlyConfigured('Could not open SHARED_CACHE_PATH: %s' % e)
+
+
+def _parse_keyring(keys, signing_kid):
+    try:
+        if isinstance(keys, str):
+            # Dotted path to a callable returning {kid: key}.
+            return KeyRing(signing_kid=signing_kid, loader=_parse_callable(keys))
+        return KeyRing(keys, signing_kid)
+
+    except KeyConfigurationError as e:
+        raise ImproperlyConfigured(str(e))
+
+
 DJANGO_SESSION_JWT = getattr(settings, 'DJANGO_SESSION_JWT', {})
 SESSION_FIELD = DJANGO_SESSION_JWT.get('SESSION_FIELD', 'sk')
-KEY, PUBKEY, ALGO = _parse_key(DJANGO_SESSION_JWT.get('KEY', settings.SECRET_KEY))
+KEY, PUBKEY, ALGO = _parse_key(
+    DJANGO_SESSION_JWT.get('KEY', settings.SECRET_KEY),
+    DJANGO_SESSION_JWT.get('ALGO'))
+KEYRING = _parse_keyring(
+    DJANGO_SESSION_JWT.get('KEYS'), DJANGO_SESSION_JWT.get('SIGNING_KID'))
 FIELDS = _parse_fields(DJANGO_SESSION_JWT.get('FIELDS', []))
+FIELD_GETTERS = _compile_fields(FIELDS)
 CALLABLE = _parse_callable(DJANGO_SESSION_JWT.get('CALLABLE'))
 EXPIRES = DJANGO_SESSION_JWT.get('EXPIRES', None)
+JWT_SESSION_KEY = 'jwt'
+REFRESH = RefreshPolicy(
+    DJANGO_SESSION_JWT.get('REFRESH_WINDOW', 0.5),
+    DJANGO_SESSION_JWT.get('REFRESH_JITTER', 0.1))
+REUSE_UNCHANGED = DJANGO_SESSION_JWT.get('REUSE_UNCHANGED', False)
+CACHE = LRUCache(DJANGO_SESSION_JWT.get('CACHE_SIZE', 0))
+SHARED_CACHE = _parse_shared_cache(
+    DJANGO_SESSION_JWT.get('SHARED_CACHE_PATH'),
+    DJANGO_SESSION_JWT.get('SHARED_CACHE_SLOTS', 65536))
+METRICS = _parse_callable(DJANGO_SESSION_JWT.get('METRICS'))
+CALLABLE_CACHE = LRUCache(DJANGO_SESSION_JWT.get('CALLABLE_CACHE_SIZE', 0))
+CALLABLE_CACHE_TTL = DJANGO_SESSION_JWT.get('CALLABLE_CACHE_TTL', 60)
+CALLABLE_CACHE_MODELS = frozenset(
+    DJANGO_SESSION_JWT.get('CALLABLE_CACHE_MODELS', ()))
+COMPACT = _parse_compact(DJANGO_SESSION_JWT.get('COMPACT', False))
+SIZE_BUDGET = DJANGO_SESSION_JWT.get('SIZE_BUDGET', 3584)
+# Decodes compressed and plain JWTs alike, whether or not COMPACT is set.
+_JWT = compact.CompactJWT() if compact.SUPPORTED else jwt
+REVOCATION_CLAIM = DJANGO_SESSION_JWT.get('REVOCATION_CLAIM', SESSION_FIELD)
+REVOCATIONS = _parse_revocations(
+    DJANGO_SESSION_JWT.get('REVOCATION_STORE'), REVOCATION_CLAIM,
+    DJANGO_SESSION_JWT.get('REVOCATION_SYNC', 10))
+TRUSTED_KEY = DJANGO_SESSION_JWT.get('TRUSTED_KEY')
+if isinstance(TRUSTED_KEY, str):
+    TRUSTED_KEY = TRUSTED_KEY.encode('utf-8')
+TRUSTED_PROXIES = _parse_trusted(
+    DJANGO_SESSION_JWT.get('TRUSTED_PROXIES'), TRUSTED_KEY)
+TRUSTED_HEADER = 'HTTP_' + DJANGO_SESSION_JWT.get(
+    'TRUSTED_HEADER', 'X-JWT-Claims').upper().replace('-', '_')
+STATELESS = DJANGO_SESSION_JWT.get('STATELESS', False)
+STATELESS_BUDGET = DJANGO_SESSION_JWT.get('STATELESS_BUDGET', 512)
+# Claim holding the session data in stateless mode.
+STATELESS_FIELD = 'sd'
+# Claim holding the session version of django_session_jwt.backends.tiered.
+VERSION_FIELD = 'sv'
+# Claims about the session rather than the user, kept when reissuing.
+SESSION_CLAIMS = (STATELESS_FIELD, VERSION_FIELD)
+BYPASS = _parse_bypass(
+    DJANGO_SESSION_JWT.get('BYPASS_PREFIXES'), DJANGO_SESSION_JWT.get('BYPASS_PATTERNS'))
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
@@ -102,53 +234,352 @@ def rgetattr(obj, name):
     return obj
 
 
-def verify_jwt(blob):
+def _emit(event, start=None):
+    "Report an event to the METRICS hook, timed from start if given."
+    METRICS(event, None if start is None else timer() - start)
+
+
+_VERIFIER = (None, None)
+
+
+def _verifier():
     """
-    Verify a JWT and return the session_key attribute from it.
+    Return the Verifier for the current settings.
+
+    Module globals can be replaced at runtime (key rotation, tests), so the
+    Verifier is rebuilt whenever one of them changes.
     """
-    try:
-        fields = jwt.decode(blob, PUBKEY, algorithms=[ALGO])
+    global _VERIFIER
+    config = (PUBKEY, ALGO, KEYRING, FIELDS, CACHE, REVOCATIONS,
+              REVOCATION_CLAIM, METRICS, SHARED_CACHE)
+    if _VERIFIER[0] != config:
+        _VERIFIER = config, Verifier(
+            PUBKEY, ALGO, KEYRING, fields_index(FIELDS), CACHE, REVOCATIONS,
+            REVOCATION_CLAIM, METRICS, SHARED_CACHE)
+    return _VERIFIER[1]
+
+
+def clear_cache():
+    "Drop all verified tokens from the cache."
+    _verifier().clear_cache()
+
+
+def revoke_jwt(fields):
+    """
+    Revoke the JWT the given verified fields came from, until it expires.
 
-    except (DecodeError, ExpiredSignatureError):
+    When REVOCATION_CLAIM is the session key, every JWT issued for the session
+    is revoked.
+    """
+    if REVOCATIONS is None:
+        raise ImproperlyConfigured(
+            'DJANGO_SESSION_JWT["REVOCATION_STORE"] is not set')
+
+    # session['jwt'] hides the session key, the raw claims have it.
+    fields = getattr(fields, 'raw', fields)
+    value = fields.get(REVOCATION_CLAIM)
+    if value is None:
+        raise ValueError('JWT has no %s claim' % REVOCATION_CLAIM)
+    REVOCATIONS.revoke(value, fields.get('exp'))
+
+
+def verify_forwarded(request, blob):
+    """
+    Return the claims a trusted proxy forwarded for the JWT blob, {} if they
+    are expired or revoked, or None if the JWT must be verified here.
+    """
+    value = request.META.get(TRUSTED_HEADER)
+    if not value or not blob or not forwarding.trusted(
+            TRUSTED_PROXIES, request.META.get('REMOTE_ADDR')):
+        return None
+
+    fields = forwarding.unsign(TRUSTED_KEY, blob, value)
+    if fields is None:
+        LOGGER.warning('Invalid forwarded claims from %s', request.META['REMOTE_ADDR'])
+        return None
+
+    exp = fields.get('exp')
+    if exp is not None and exp <= time.time():
+        if METRICS:
+            _emit('forwarded.expired')
         return {}
 
-    # Convert short names to long names.
-    for _, sname, lname in FIELDS:
-        try:
-            # Leave both short and long forms in dictionary.
-            fields[lname] = fields[sname]
+    verifier = _verifier()
+    if verifier.is_revoked(fields):
+        if METRICS:
+            _emit('verify.revoked')
+        return {}
+
+    if METRICS:
+        _emit('forwarded')
+    return Claims(fields, verifier.index)
+
+
+def verify_jwt(blob):
+    """
+    Verify a JWT and return its claims, or {} if it is invalid.
+
+    The claims are a read-only Claims mapping, which also answers to the long
+    names from FIELDS.
+    """
+    return _verifier().verify(blob)
+
+
+@lru_cache()
+def _user_select_related(model):
+    return _select_related(FIELDS, model)
+
+
+def user_queryset():
+    """
+    Return a queryset of users that joins the relations FIELDS traverse, so
+    building a JWT takes a single query.
+    """
+    User = get_user_model()
+    related = _user_select_related(User)
+    queryset = User._default_manager.all()
+    return queryset.select_related(*related) if related else queryset
+
+
+def invalidate_fields(user_id=None):
+    """
+    Drop the cached CALLABLE result for user_id, or for all users.
+    """
+    if user_id is None:
+        CALLABLE_CACHE.clear()
+    else:
+        CALLABLE_CACHE.pop(user_id)
 
-        except KeyError:
-            continue
 
+def _invalidate_instance(sender, instance, **kwargs):
+    if isinstance(instance, get_user_model()):
+        invalidate_fields(instance.pk)
+    else:
+        # No way to tell which users are affected.
+        invalidate_fields()
+
+
+def _invalidate_m2m(sender, instance, action, model, pk_set=None, **kwargs):
+    if not action.startswith('post_'):
+        return
+
+    labels = (instance._meta.label, model._meta.label)
+    if not CALLABLE_CACHE_MODELS.intersection(labels):
+        return
+
+    User = get_user_model()
+    if isinstance(instance, User):
+        invalidate_fields(instance.pk)
+    elif model is User and pk_set:
+        for pk in pk_set:
+            invalidate_fields(pk)
+    else:
+        invalidate_fields()
+
+
+def _connect_invalidation(labels):
+    "Invalidate cached CALLABLE results when the given models change."
+    for label in labels:
+        post_save.connect(_invalidate_instance, sender=label)
+        post_delete.connect(_invalidate_instance, sender=label)
+    if labels:
+        m2m_changed.connect(_invalidate_m2m)
+
+
+_connect_invalidation(CALLABLE_CACHE_MODELS)
+
+
+def _callable_fields(user):
+    pk = getattr(user, 'pk', None)
+    if CALLABLE_CACHE.maxsize <= 0 or pk is None:
+        return CALLABLE(user)
+
+    fields = CALLABLE_CACHE.get(pk)
+    if fields is None:
+        fields = CALLABLE(user)
+        CALLABLE_CACHE.set(pk, fields, time.time() + CALLABLE_CACHE_TTL)
     return fields
 
 
-def create_jwt(user, session_key, expires=None):
+def user_fields(user):
     """
-    Create a JWT for the given user containing the configured fields.
+    Return the configured fields (by short name) for the given user.
     """
-    fields = {
+    fields = {}
+    for getter, sname, attrname in FIELD_GETTERS:
+        try:
+            fields[sname] = getter(user)
+
+        except AttributeError:
+            # Omit missing fields:
+            LOGGER.warning('Could not get missing field %s from user', attrname)
+            continue
+
+    if CALLABLE:
+        fields.update(_callable_fields(user))
+
+    return fields
+
+
+def _claims(user, session_key, expires=None, fields=None):
+    claims = {
         SESSION_FIELD: session_key,
         'iat': datetime.utcnow(),
     }
     if expires:
         # Set a future expiration date.
-        fields['exp'] = datetime.utcnow() + timedelta(seconds=expires)
+        claims['exp'] = datetime.utcnow() + timedelta(seconds=expires)
+    if REVOCATION_CLAIM == 'jti':
+        claims['jti'] = secrets.token_urlsafe(12)
 
-    for attrname, sname, _ in FIELDS:
+    claims.update(user_fields(user) if fields is None else fields)
+    return claims
+
+
+def _signing_key():
+    "Return (key, algo, headers) to sign new JWTs with."
+    signing = KEYRING.signing
+    if signing is None:
+        return KEY, ALGO, {}
+
+    kid, key, algo = signing
+    return key, algo, {'kid': kid}
+
+
+def _check_size(blob):
+    if SIZE_BUDGET and len(blob) > SIZE_BUDGET:
+        LOGGER.warning(
+            'JWT is %d bytes, over the SIZE_BUDGET of %d bytes. Browsers '
+            'reject cookies over 4096 bytes.', len(blob), SIZE_BUDGET)
+
+
+def create_jwt(user, session_key, expires=None, fields=None):
+    """
+    Create a JWT for the given user containing the configured fields.
+
+    Precomputed user_fields(user) can be passed as fields.
+    """
+    return _encode(_claims(user, session_key, expires, fields))
+
+
+def _encode(claims):
+    "Sign claims with the signing key."
+    start = METRICS and timer()
+    key, algo, headers = _signing_key()
+    encoder = _JWT if COMPACT else jwt
+    blob = encoder.encode(claims, key, algorithm=algo, headers=headers)
+
+    if METRICS:
+        _emit('encode', start)
+
+    _check_size(blob)
+    return blob
+
+
+def create_jwt_many(pairs, expires=None, executor=None, chunk_size=500):
+    """
+    Yield a JWT for each (user, session_key) in pairs, or None where user is
+    None. Pairs can have a third item, claims to add to the user fields.
+
+    Claims are built in this process, signing happens in executor (for example
+    a ProcessPoolExecutor) when given, chunk_size JWTs at a time.
+    """
+    key, algo, headers = _signing_key()
+    key = batch.portable_key(key)
+
+    def item(user, session_key, claims=None):
+        if user is None:
+            return None
+        fields = user_fields(user)
+        fields.update(claims or {})
+        return (_claims(user, session_key, expires, fields), key, algo,
+                dict(headers), COMPACT)
+
+    def items(chunk):
+        return [item(*pair) for pair in chunk]
+
+    chunks = (items(chunk) for chunk in batch.chunks(pairs, chunk_size))
+    for blob in _map_present(batch.encode_chunk, chunks, executor):
+        if blob is not None:
+            _check_size(blob)
+        yield blob
+
+
+def verify_jwt_many(blobs, executor=None, chunk_size=500):
+    """
+    Yield the claims of each JWT in blobs, or {} where it is invalid.
+
+    Signatures are checked in executor when given, chunk_size JWTs at a time.
+    """
+    verifier, keys = _verifier(), {}
+
+    def item(blob):
         try:
-            fields[sname] = rgetattr(user, attrname)
+            key, algo = verifier.verification_key(blob)
 
-        except AttributeError:
-            # Omit missing fields:
-            LOGGER.warning('Could not get missing field %s from user', attrname)
-            continue
+        except InvalidTokenError:
+            return None
 
-    if CALLABLE:
-        fields.update(CALLABLE(user))
+        # Serialize each key once, keys may not be hashable.
+        if id(key) not in keys:
+            keys[id(key)] = batch.portable_key(key)
+        return blob, keys[id(key)], algo
+
+    chunks = ([item(blob) for blob in chunk] for chunk in batch.chunks(blobs, chunk_size))
+    for fields in _map_present(batch.decode_chunk, chunks, executor):
+        if fields is None or verifier.is_revoked(fields):
+            yield {}
+        else:
+            yield Claims(fields, verifier.index)
+
+
+def _map_present(func, chunks, executor):
+    "Like batch.map_chunks(), but flat and passing None items through."
+    pending = deque()
+
+    def present():
+        for chunk in chunks:
+            pending.append(chunk)
+            yield [item for item in chunk if item is not None]
+
+    for results in batch.map_chunks(func, present(), executor):
+        results = iter(results)
+        for item in pending.popleft():
+            yield None if item is None else next(results)
 
-    return jwt.encode(fields, KEY, algorithm=ALGO)
+
+def reissue_jwt_many(blobs, expires=None, executor=None, chunk_size=500):
+    """
+    Yield a new JWT, with the current FIELDS and signing key, for the user and
+    session of each JWT in blobs, or None where it is invalid or the user no
+    longer exists. Session data and versions (SESSION_CLAIMS) are kept. Users
+    are fetched chunk_size at a time.
+    """
+    def pairs():
+        for chunk in batch.chunks(verify_jwt_many(blobs, executor, chunk_size), chunk_size):
+            users = user_queryset().in_bulk(
+                set(fields['user_id'] for fields in chunk if fields.get('user_id') is not None))
+            for fields in chunk:
+                claims = dict(
+                    (name, fields[name]) for name in SESSION_CLAIMS if name in fields)
+                yield users.get(fields.get('user_id')), fields.get(SESSION_FIELD), claims
+
+    return create_jwt_many(pairs(), expires, executor, chunk_size)
+
+
+def _reusable(session, session_key, fields):
+    """
+    Check whether the JWT the session was loaded from holds exactly the given
+    session key and user fields, so it can be sent again instead of signing.
+    """
+    old = session.jwt
+    if not old or session._token is None or session._session_key != session_key:
+        return False
+
+    old = dict(
+        (k, v) for k, v in getattr(old, 'raw', old).items()
+        if k not in ('iat', 'exp', 'jti', SESSION_FIELD))
+    return old == fields
 
 
 def convert_cookie(cookies, user):
@@ -157,55 +588,364 @@ def convert_cookie(cookies, user):
         user, cookie.value, EXPIRES)
 
 
+def _stateless_data(store):
+    "Return the session data if it can be carried in the JWT, None otherwise."
+    data = dict(store.items())
+    try:
+        size = len(json.dumps(data, separators=(',', ':')))
+
+    except (TypeError, ValueError):
+        # Only JSON serializable data can be put in the JWT.
+        return None
+
+    return data if size <= STATELESS_BUDGET else None
+
+
+def _session_fields(request):
+    return getattr(getattr(request, 'session', None), 'jwt', None) or {}
+
+
+class LazySession(object):
+    """
+    Session proxy that constructs the session store on first use.
+
+    The verified JWT fields are exposed as session['jwt']. They are an
+    overlay: they are never written to the session backend and reading them
+    does not mark the session as modified or create the session store.
+    Flushing or clearing the session drops them. Any other access creates the
+    store and delegates to it.
+
+    Session stores may define set_jwt_claims(claims), called with the
+    verified JWT fields, and jwt_claims(), returning claims to add to the next
+    JWT.
+
+    Session data carried in the JWT (see STATELESS) is loaded into the store
+    instead of reading the session backend. When saving in stateless mode,
+    data that fits STATELESS_BUDGET is kept for the next JWT instead of being
+    written to the backend.
+    """
+
+    def __init__(self, SessionStore, session_key, jwt=None, token=None, data=None):
+        self.__dict__.update(
+            _SessionStore=SessionStore, _session_key=session_key, _jwt=jwt,
+            _token=token, _data=data, _store=None, _accessed=False)
+
+    def _get_store(self):
+        if self._store is None:
+            store = self._SessionStore(self._session_key)
+            store.accessed = store.accessed or self._accessed
+            if self._data is not None:
+                # Stands in for store.load(), which is not called while set.
+                store._session_cache = dict(self._data)
+            if self._jwt is not None and hasattr(store, 'set_jwt_claims'):
+                store.set_jwt_claims(self._jwt)
+            self.__dict__['_store'] = store
+        return self._store
+
+    def save(self, must_create=False):
+        store = self._get_store()
+        data = _stateless_data(store) if STATELESS else None
+        stateless, self.__dict__['_data'] = self._data is not None, data
+        if data is None and stateless and store.session_key is not None:
+            # Moving to the backend, which may not know the session key yet.
+            try:
+                store.save(must_create=True)
+
+            except CreateError:
+                store.save()
+        elif data is None:
+            store.save(must_create)
+        elif store.session_key is None:
+            # New session, pick a key without asking the backend.
+            store._session_key = get_random_string(32, VALID_KEY_CHARS)
+
+    def jwt_claims(self):
+        "Return the claims to add to the next JWT for this session."
+        claims = {}
+        if hasattr(self._store, 'jwt_claims'):
+            # Session engines can carry their own claims, see backends.tiered.
+            claims.update(self._store.jwt_claims())
+        if self._data is not None:
+            claims[STATELESS_FIELD] = self._data
+        return claims
+
+    def _access_jwt(self):
+        if self._store is None:
+            self.__dict__['_accessed'] = True
+        else:
+            self._store.accessed = True
+        return self._jwt
+
+    @property
+    def jwt(self):
+        return self._jwt
+
+    @property
+    def accessed(self):
+        if self._store is None:
+            return self._accessed
+        return self._store.accessed
+
+    @property
+    def modified(self):
+        if self._store is None:
+            return False
+        return self._store.modified
+
+    def is_empty(self):
+        if self._store is None:
+            return not self._session_key
+        return self._store.is_empty()
+
+    def __getitem__(self, key):
+        if key == JWT_SESSION_KEY:
+            if self._access_jwt() is None:
+                raise KeyError(key)
+            return self._jwt
+        return self._get_store()[key]
+
+    def __contains__(self, key):
+        if key == JWT_SESSION_KEY:
+            return self._jwt is not None
+        return key in self._get_store()
+
+    def get(self, key, default=None):
+        if key == JWT_SESSION_KEY:
+            jwt = self._access_jwt()
+            return default if jwt is None else jwt
+        return self._get_store().get(key, default)
+
+    def __setitem__(self, key, value):
+        self._get_store()[key] = value
+
+    def __delitem__(self, key):
+        del self._get_store()[key]
+
+    def clear(self):
+        self.__dict__['_jwt'] = None
+        self._get_store().clear()
+        self.__dict__['_data'] = None
+
+    def _revoke(self):
+        "Revoke the incoming JWT, the session it was issued for is going away."
+        if REVOCATIONS is not None and self._jwt is not None:
+            revoke_jwt(self._jwt)
+
+    def flush(self):
+        self._revoke()
+        self.__dict__['_jwt'] = None
+        store = self._get_store()
+        if STATELESS and self._data is not None:
+            # The session is only in the JWT, there is nothing to delete.
+            store.clear()
+            store._session_key = None
+        else:
+            store.flush()
+        self.__dict__['_data'] = None
+
+    def cycle_key(self):
+        self._revoke()
+        store = self._get_store()
+        if not STATELESS:
+            store.cycle_key()
+            return
+
+        # Like SessionBase.cycle_key(), but the new key is only saved to the
+        # backend if the data does not fit in the JWT.
+        data, key = store._get_session(), store.session_key
+        store._session_key = get_random_string(32, VALID_KEY_CHARS)
+        store._session_cache = data
+        store.modified = True
+        if key and self._data is None:
+            store.delete(key)
+        # Not in the backend, as if it came from the JWT.
+        self.__dict__['_data'] = data
+
+    def __getattr__(self, name):
+        return getattr(self._get_store(), name)
+
+    def __setattr__(self, name, value):
+        if name == 'jwt':
+            self.__dict__['_jwt'] = value
+        else:
+            setattr(self._get_store(), name, value)
+
+
+class BypassSession(LazySession):
+    """
+    Empty session for requests matching BYPASS_PREFIXES / BYPASS_PATTERNS.
+    The JWT is not read and changes are not saved.
+    """
+
+    def __init__(self, SessionStore):
+        super(BypassSession, self).__init__(SessionStore, None)
+
+
 class SessionMiddleware(BaseSessionMiddleware):
     """
     Extend django.contrib.sessions middleware to use JWT as session cookie.
     """
 
+    def _bypass(self, request):
+        if BYPASS is None or not BYPASS(request.path_info):
+            return False
+        request.session = BypassSession(self.SessionStore)
+        return True
+
     def process_request(self, request):
-        session_jwt = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
-        fields = verify_jwt(session_jwt)
+        if self._bypass(request):
+            return
 
-        session_key = fields.pop(SESSION_FIELD, None)
-        request.session = self.SessionStore(session_key)
+        session_jwt = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        fields = verify_forwarded(request, session_jwt) if TRUSTED_PROXIES else None
+        if fields is None:
+            fields = verify_jwt(session_jwt)
+        self._set_session(request, fields, session_jwt)
+
+    def _set_session(self, request, fields, token=None):
+        session_key = fields.get(SESSION_FIELD)
+        # Read even if STATELESS was turned off, saving moves it to the backend.
+        data = fields.get(STATELESS_FIELD)
         if fields:
-            request.session['jwt'] = fields
+            # The session key and data are not part of session['jwt'].
+            fields = fields.exclude(SESSION_FIELD, STATELESS_FIELD)
+        request.session = LazySession(
+            self.SessionStore, session_key, fields or None,
+            token if fields else None, data)
+
+    def _lookup_user(self, fields):
+        "Determine the user by the session JWT."
+        User = get_user_model()
+        user_id = fields.get('user_id')
+        if user_id is None:
+            return None
+
+        start = METRICS and timer()
+        try:
+            return user_queryset().get(id=user_id)
 
-    def process_response(self, request, response):
-        if not request.user.is_authenticated:
-            # The user is unauthenticated. Try to determine the user by the
-            # session JWT
-            User = get_user_model()
-            try:
-                user_id = request.session['jwt']['user_id']
-                user = User.objects.get(id=user_id)
-            except (KeyError, User.DoesNotExist):
-                # Unable to determine the user. ID will not be set in the JWT.
-                user = None
-        else:
-            user = request.user
+        except User.DoesNotExist:
+            # Unable to determine the user. ID will not be set in the JWT.
+            return None
+
+        finally:
+            if METRICS:
+                _emit('user_lookup', start)
+
+    def _refresh_due(self, request, fields):
+        "Check whether the incoming JWT has entered its refresh window."
+        if not fields or not REFRESH.due(fields, request.session._session_key):
+            return False
 
+        if not request.session.is_empty():
+            # contrib.sessions only sets the cookie when saving the session.
+            request.session.modified = True
+        return True
+
+    def _reissue_due(self, request, response, refresh):
+        # Behave the same as contrib.sessions, only recreate the JWT if the session
+        # was modified or SESSION_SAVE_EVERY_REQUEST is enabled.
+        reissue = refresh or request.session.modified or \
+            settings.SESSION_SAVE_EVERY_REQUEST
+        # There is nothing to convert unless contrib.sessions set the cookie.
+        return reissue and settings.SESSION_COOKIE_NAME in response.cookies
+
+    def _reissue_claims(self, request, response, user, refresh):
+        """
+        Return the claims of the JWT to issue, or None when there is no session
+        cookie or the JWT the client has is sent again.
+        """
+        try:
+            session_key = response.cookies[settings.SESSION_COOKIE_NAME].value
+            fields = user_fields(user)
+            fields.update(request.session.jwt_claims())
+
+        except (KeyError, AttributeError):
+            # No cookie, no problem...
+            return None
+
+        if REUSE_UNCHANGED and not refresh and \
+           _reusable(request.session, session_key, fields):
+            # Nothing changed, send the JWT the client already has.
+            response.cookies[settings.SESSION_COOKIE_NAME] = request.session._token
+            if METRICS:
+                _emit('reuse')
+            return None
+
+        return _claims(user, session_key, EXPIRES, fields)
+
+    def _set_jwt(self, response, blob, refresh):
+        response.cookies[settings.SESSION_COOKIE_NAME] = blob
+
+        if METRICS:
+            _emit('reissue')
+            if refresh:
+                _emit('refresh')
+
+    def _reissue(self, request, response, user, refresh):
+        claims = self._reissue_claims(request, response, user, refresh)
+        if claims is not None:
+            self._set_jwt(response, _encode(claims), refresh)
+
+    def _save_session(self, request, response):
         # Rather than duplicating the session logic here, just allow super()
         # to do it's thing, then convert the session cookie (if any) when it's
         # done.
+        start = METRICS and timer()
         super(SessionMiddleware, self).process_response(request, response)
+        if METRICS:
+            _emit('session_save', start)
+
+    def _check_user(self, request, user):
+        """
+        Return user if the session is still logged in as user, as
+        contrib.auth checks it: a JWT copied before logging out, or whose user
+        was deactivated or changed their password, is not signed again with
+        the user fields.
+        """
+        if user is None or not getattr(user, 'is_active', True):
+            return None
 
-        # Determine if JWT is more than halfway through it's lifetime.
-        expires = getattr(request, 'session', {}).get('jwt', {}).get('exp', None)
-        halftime = time.mktime((datetime.utcnow() + timedelta(seconds=EXPIRES / 2)).timetuple())
-        halflife = expires and expires <= halftime
+        try:
+            user_id = user._meta.pk.to_python(request.session[SESSION_KEY])
 
-        # Behave the same as contrib.sessions, only recreate the JWT if the session
-        # was modified or SESSION_SAVE_EVERY_REQUEST is enabled.
-        if not halflife and not request.session.modified and \
-           not settings.SESSION_SAVE_EVERY_REQUEST:
+        except (KeyError, ValidationError):
+            return None
+
+        if user_id != user.pk:
+            return None
+
+        if hasattr(user, 'get_session_auth_hash'):
+            session_hash = request.session.get(HASH_SESSION_KEY)
+            if not session_hash or not constant_time_compare(
+                    session_hash, user.get_session_auth_hash()):
+                return None
+        return user
+
+    def _get_user(self, request, fields):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated and \
+           not getattr(user, 'from_jwt', False):
+            return user
+
+        # The user is unauthenticated, or taken from the JWT without checking
+        # the database. Try to determine the user by the session JWT.
+        return self._check_user(request, self._lookup_user(fields))
+
+    def process_response(self, request, response):
+        if isinstance(getattr(request, 'session', None), BypassSession):
             return response
 
-        try:
-            convert_cookie(response.cookies, user)
+        # The fields of the incoming JWT, unless the session was flushed.
+        fields = _session_fields(request)
+        refresh = self._refresh_due(request, fields)
 
-        except (KeyError, AttributeError):
-            # No cookie, no problem...
-            pass
+        self._save_session(request, response)
+
+        # Only resolve the user (which may load the session and query the
+        # database) when a new JWT will actually be signed.
+        if self._reissue_due(request, response, refresh):
+            self._reissue(
+                request, response, self._get_user(request, fields), refresh)
 
         return response
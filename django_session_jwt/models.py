@@ -1,3 +1,15 @@
 from django.db import models
 
-# Create your models here.
+
+class RevokedToken(models.Model):
+    """
+    A revoked session key or JWT id, see django_session_jwt.revocation.
+    """
+
+    value = models.CharField(max_length=255, db_index=True)
+    # JWT exp (seconds since the epoch), the row is useless after that.
+    expires = models.BigIntegerField(null=True, blank=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.value
@@ -0,0 +1,41 @@
+import hashlib
+import time
+
+
+class RefreshPolicy(object):
+    """
+    Decide when a JWT should be signed again.
+
+    A JWT is due for refresh once less than window (a fraction) of its own
+    lifetime, exp - iat, remains. So that JWTs issued at the same moment (a
+    login peak, a deploy) are not all re-signed at the same moment, the window
+    of each session is widened by a deterministic jitter of up to
+    jitter * lifetime derived from the session key.
+    """
+
+    def __init__(self, window=0.5, jitter=0.0):
+        self.window = window
+        self.jitter = jitter
+
+    def offset(self, session_key):
+        "Return a stable value in [0, 1) for session_key."
+        if not session_key:
+            return 0.0
+        digest = hashlib.sha1(session_key.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') / float(1 << 64)
+
+    def refresh_at(self, fields, session_key=None):
+        "Return the time (seconds since the epoch) the JWT is due, or None."
+        exp, iat = fields.get('exp'), fields.get('iat')
+        if not exp or iat is None:
+            return None
+
+        lifetime = exp - iat
+        window = self.window + self.jitter * self.offset(session_key)
+        return exp - lifetime * window
+
+    def due(self, fields, session_key=None, now=None):
+        refresh_at = self.refresh_at(fields, session_key)
+        if refresh_at is None:
+            return False
+        return (time.time() if now is None else now) >= refresh_at
@@ -0,0 +1,203 @@
+"""
+Revoke JWTs before they expire.
+
+Revoked values (session keys, or JWT ids when REVOCATION_CLAIM is "jti") are
+written to a shared store. Each process keeps an in-memory copy of the list
+that verify_jwt() checks, and pulls new entries from the store every
+REVOCATION_SYNC seconds in a background thread, so requests (including those
+on an ASGI event loop) never wait on the store.
+
+A store implements add(value, expires) and changes(cursor), which returns
+([(value, expires), ...], cursor) for the entries added after cursor (None
+for all entries). expires is the JWT exp, seconds since the epoch, or None.
+A store can also implement close(), called in the background thread after
+each sync to release resources such as its database connection.
+"""
+import logging
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class RevocationList(object):
+    """
+    In-memory revocation list synchronized from a store.
+    """
+
+    def __init__(self, store, interval=10):
+        self.store = store
+        self.interval = interval
+        self._revoked = {}
+        self._cursor = None
+        self._next_sync = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def sync(self):
+        "Pull new entries from the store and drop expired ones."
+        with self._lock:
+            self._next_sync = time.time() + self.interval
+            entries, self._cursor = self.store.changes(self._cursor)
+
+            now = time.time()
+            revoked = dict(
+                (value, expires) for value, expires in self._revoked.items()
+                if expires is None or expires > now)
+            revoked.update(entries)
+            self._revoked = revoked
+
+    def revoke(self, value, expires=None):
+        self.store.add(value, expires)
+        # Effective in this process right away, others pick it up on sync.
+        self._revoked[value] = expires
+
+    def _sync_in_background(self):
+        try:
+            self.sync()
+
+        except Exception:
+            # Keep using the list we have until the store is back.
+            LOGGER.warning('Could not sync revocation list', exc_info=True)
+
+        finally:
+            close = getattr(self.store, 'close', None)
+            if close is not None:
+                close()
+
+    def _start_sync(self):
+        with self._lock:
+            if time.time() < self._next_sync:
+                # Started by another thread.
+                return
+            self._next_sync = time.time() + self.interval
+            self._thread = threading.Thread(
+                target=self._sync_in_background, name='django_session_jwt.revocation',
+                daemon=True)
+            self._thread.start()
+
+    def __contains__(self, value):
+        if time.time() >= self._next_sync:
+            self._start_sync()
+
+        return value in self._revoked
+
+    def __len__(self):
+        return len(self._revoked)
+
+
+class _GapTracker(object):
+    """
+    Move a cursor over numbered entries, stopping at missing numbers.
+
+    A number without an entry may still be in flight (being written, or in an
+    uncommitted transaction): the cursor stops there, and only moves past it
+    once it has been missing for grace seconds.
+    """
+
+    def __init__(self, grace):
+        self.grace = grace
+        # {entry number: when it was first found missing}
+        self._missing = {}
+
+    def advance(self, cursor, numbers, present):
+        now, missing, advance = time.time(), {}, True
+        for n in numbers:
+            if n not in present:
+                missing[n] = self._missing.get(n, now)
+                # Gone for good (expired, or the writer failed) after grace.
+                advance = advance and now - missing[n] >= self.grace
+            if advance:
+                cursor = n
+        self._missing = missing
+        return cursor
+
+
+class DatabaseStore(object):
+    """
+    Store revocations in the RevokedToken table.
+
+    Requires django_session_jwt in INSTALLED_APPS. Call prune() periodically
+    to delete expired rows.
+
+    Rows can commit out of primary key order, so the cursor stops at a gap in
+    the primary keys until it has been there for grace seconds.
+    """
+
+    def __init__(self, grace=10):
+        self._gaps = _GapTracker(grace)
+
+    def _model(self):
+        from django_session_jwt.models import RevokedToken
+        return RevokedToken
+
+    def add(self, value, expires=None):
+        self._model().objects.create(value=value, expires=expires)
+
+    def changes(self, cursor):
+        cursor = cursor or 0
+        rows = self._model().objects.filter(pk__gt=cursor).order_by('pk')
+        rows = list(rows.values_list('pk', 'value', 'expires'))
+        if not rows:
+            return [], cursor
+
+        cursor = self._gaps.advance(
+            cursor, range(cursor + 1, rows[-1][0] + 1), set(pk for pk, _, _ in rows))
+        return [(value, expires) for _, value, expires in rows], cursor
+
+    def close(self):
+        # Syncing runs in a thread Django does not manage, close its connections.
+        from django.db import connections
+        connections.close_all()
+
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        self._model().objects.filter(expires__lte=now).delete()
+
+
+class CacheStore(object):
+    """
+    Store revocations in a Django cache as a numbered log.
+
+    Entries expire from the cache with the JWT they revoke. Use a cache that
+    is shared by all processes and does not evict entries early.
+
+    An entry is numbered before it is written, so the cursor stops at a
+    number without an entry until it has been missing for grace seconds.
+    """
+
+    def __init__(self, alias='default', prefix='django_session_jwt:revoked', grace=10):
+        self.alias = alias
+        self.prefix = prefix
+        self._gaps = _GapTracker(grace)
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def close(self):
+        self.cache.close()
+
+    def _key(self, n):
+        return '%s:%d' % (self.prefix, n)
+
+    def add(self, value, expires=None):
+        cache, counter = self.cache, self._key(0)
+        cache.add(counter, 0, None)
+        n = cache.incr(counter)
+        timeout = None if expires is None else max(int(expires - time.time()), 1)
+        cache.set(self._key(n), (value, expires), timeout)
+
+    def changes(self, cursor):
+        last = self.cache.get(self._key(0), 0)
+        if cursor is None or cursor > last:
+            # First sync, or the cache was cleared.
+            cursor = 0
+
+        numbers = range(cursor + 1, last + 1)
+        entries = self.cache.get_many([self._key(n) for n in numbers])
+        present = set(n for n in numbers if self._key(n) in entries)
+        return list(entries.values()), self._gaps.advance(cursor, numbers, present)
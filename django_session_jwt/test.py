@@ -1,35 +1,228 @@
+import random
+
 from importlib import import_module
+from timeit import default_timer as timer
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.backends.base import VALID_KEY_CHARS
 from django.test.client import Client as BaseClient
-from django.contrib.auth import SESSION_KEY, get_user_model
+from django.test.client import RequestFactory
+from django.utils.crypto import get_random_string
 
-from django_session_jwt.middleware import convert_cookie, verify_jwt
+from django_session_jwt import batch
+from django_session_jwt.middleware import SessionMiddleware, convert_cookie, verify_jwt
+from django_session_jwt.middleware import session as jwt_session
+from django_session_jwt.middleware.session import STATELESS_FIELD
 
 
 User = get_user_model()
 
 
 class Client(BaseClient):
-    def login(self, **credentials):
-        ret = super(Client, self).login(**credentials)
-        if ret:
-            user = User.objects.get(id=int(self.session[SESSION_KEY]))
-            convert_cookie(self.cookies, user)
-        return ret
+    def _login(self, user, backend=None):
+        # Used by login() and force_login(). The user is already loaded, but
+        # without the relations FIELDS traverse.
+        super(Client, self)._login(user, backend)
+        if jwt_session._user_select_related(User):
+            user = jwt_session.user_queryset().get(pk=user.pk)
+        convert_cookie(self.cookies, user)
+
+    def _session(self, fields, cookie):
+        engine = import_module(settings.SESSION_ENGINE)
+        session = engine.SessionStore(fields.get('sk', cookie.value))
+        if STATELESS_FIELD in fields:
+            # Stateless session, the data is in the JWT.
+            session._session_cache = dict(fields[STATELESS_FIELD])
+        return session
 
     @property
     def session(self):
         """
         Obtains the current session variables.
         """
-        engine = import_module(settings.SESSION_ENGINE)
         cookie = self.cookies.get(settings.SESSION_COOKIE_NAME)
         if cookie:
-            sk = verify_jwt(cookie.value).get('sk', cookie.value)
-            return engine.SessionStore(sk)
+            return self._session(verify_jwt(cookie.value), cookie)
 
+        engine = import_module(settings.SESSION_ENGINE)
         session = engine.SessionStore()
         session.save()
         self.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
         return session
+
+
+class CachedClient(Client):
+    """
+    Client whose session property returns the same session store until a
+    request is made or the session cookie changes, instead of verifying the
+    cookie and loading the session on every access.
+    """
+
+    _cached_session = (None, None)
+
+    def request(self, **request):
+        self._cached_session = (None, None)
+        return super(CachedClient, self).request(**request)
+
+    @property
+    def session(self):
+        cookie = self.cookies.get(settings.SESSION_COOKIE_NAME)
+        if not cookie:
+            return super(CachedClient, self).session
+
+        if self._cached_session[0] != cookie.value:
+            self._cached_session = (
+                cookie.value, self._session(verify_jwt(cookie.value), cookie))
+        return self._cached_session[1]
+
+
+class TokenFactory(object):
+    """
+    Mint session JWTs for synthetic users in bulk, without the database or the
+    login flow.
+
+    User n is an unsaved user instance with pk n and a username (and email,
+    if the user model has one) derived from n. Claims are read from it as
+    configured by FIELDS; CALLABLE is not called, pass its claims as extra.
+    Signing happens in executor when given, chunk_size JWTs at a time.
+
+    Each method returns [(user, session key, JWT), ...] for count users,
+    starting at user start.
+    """
+
+    def __init__(self, expires=60, extra=None, executor=None, chunk_size=500):
+        self.expires = expires
+        self.extra = extra or {}
+        self.executor = executor
+        self.chunk_size = chunk_size
+
+    def user(self, n):
+        user = User(pk=n)
+        setattr(user, User.USERNAME_FIELD, 'user%d' % n)
+        if hasattr(user, 'email'):
+            user.email = 'user%d@example.com' % n
+        return user
+
+    def fields(self, user):
+        fields = {}
+        for getter, sname, _ in jwt_session.FIELD_GETTERS:
+            try:
+                fields[sname] = getter(user)
+
+            except AttributeError:
+                continue
+
+        fields.update(self.extra)
+        return fields
+
+    def _mint(self, count, start, expires):
+        key, algo, headers = jwt_session._signing_key()
+        key = batch.portable_key(key)
+        users = [self.user(n) for n in range(start, start + count)]
+        keys = [get_random_string(32, VALID_KEY_CHARS) for _ in users]
+        items = [
+            (jwt_session._claims(user, session_key, expires, self.fields(user)),
+             key, algo, dict(headers), jwt_session.COMPACT)
+            for user, session_key in zip(users, keys)
+        ]
+
+        blobs = []
+        for chunk in batch.map_chunks(
+                batch.encode_chunk, batch.chunks(items, self.chunk_size),
+                self.executor):
+            blobs.extend(chunk)
+        return list(zip(users, keys, blobs))
+
+    def valid(self, count, start=1):
+        return self._mint(count, start, self.expires)
+
+    def expired(self, count, start=1):
+        # Expired a minute ago, beyond any clock leeway a test might use.
+        return self._mint(count, start, -60)
+
+    def tampered(self, count, start=1):
+        "Valid JWTs with a corrupted signature."
+        tokens = []
+        for user, session_key, blob in self._mint(count, start, self.expires):
+            head, signature = blob.rsplit('.', 1)
+            # Each character of the signature encodes 6 bits of it.
+            char = 'B' if signature[0] == 'A' else 'A'
+            tokens.append((user, session_key, '%s.%s%s' % (head, char, signature[1:])))
+        return tokens
+
+
+class LoadHarness(object):
+    """
+    Drive SessionMiddleware (or another middleware stack) with many distinct
+    sessions, without the URL resolver or the network.
+
+    Like locust users, each simulated user holds a session cookie (a JWT from
+    factory) and repeatedly runs one of tasks, picked by weight. Tasks are
+    (weight, method, path, data) tuples and every request is answered by view.
+    request.user is set to the synthetic user, standing in for the
+    authentication middleware. Cookies set by responses are kept for the
+    user's next request, as a browser would.
+    """
+
+    def __init__(self, view, middleware=(SessionMiddleware,), factory=None,
+                 tasks=((1, 'get', '/', None),), seed=None):
+        handler = view
+        for cls in reversed(middleware):
+            handler = cls(handler)
+        self.handler = handler
+        self.factory = factory or TokenFactory()
+        self.tasks = tasks
+        self.random = random.Random(seed)
+        self.requests = RequestFactory()
+
+    def _request(self, user, cookies, task):
+        _, method, path, data = task
+        request = getattr(self.requests, method)(path, data or {})
+        request.COOKIES.update(cookies)
+        request.user = user
+
+        start = timer()
+        response = self.handler(request)
+        duration = timer() - start
+
+        for name, morsel in response.cookies.items():
+            cookies[name] = morsel.value
+        return response.status_code, duration
+
+    def run(self, users=1000, requests=10000):
+        """
+        Make requests requests spread over users users, and return
+        {'requests', 'errors', 'seconds', 'rps', 'p50', 'p90', 'p99'}
+        (latencies in seconds). Responses with a 5xx status are errors.
+        """
+        name = settings.SESSION_COOKIE_NAME
+        sessions = [
+            (user, {name: blob}) for user, _, blob in self.factory.valid(users)]
+        weights = [task[0] for task in self.tasks]
+
+        durations, errors = [], 0
+        start = timer()
+        for _ in range(requests):
+            user, cookies = self.random.choice(sessions)
+            task = self.random.choices(self.tasks, weights)[0]
+            status, duration = self._request(user, cookies, task)
+            durations.append(duration)
+            errors += status >= 500
+        seconds = timer() - start
+
+        durations.sort()
+
+        def percentile(p):
+            return durations[min(int(len(durations) * p), len(durations) - 1)] \
+                if durations else 0
+
+        return {
+            'requests': requests,
+            'errors': errors,
+            'seconds': seconds,
+            'rps': requests / seconds if seconds else 0,
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+        }
@@ -1,23 +1,66 @@
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import time
-from unittest import mock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest import mock, skipUnless
 
 from os.path import dirname, normpath
 from os.path import join as pathjoin
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from io import StringIO
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
 from django.test import override_settings
 from django.test import TestCase
 from django.contrib.auth import get_user_model
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import Group, Permission
+from django.contrib.sessions.backends.db import SessionStore
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.test.client import Client as BaseClient
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
 
+from django_session_jwt import compact, forwarding
+from django_session_jwt.backends import tiered
+from django_session_jwt.cache import LRUCache, SharedCache
+from django_session_jwt.claims import Claims
+from django_session_jwt import views
+from django_session_jwt.auth import JWTAuthenticationMiddleware, user_from_jwt
+from django_session_jwt.metrics import StatsdMetrics
 from django_session_jwt.middleware import session
-from django_session_jwt.test import Client
+from django_session_jwt.models import RevokedToken
+from django_session_jwt.refresh import RefreshPolicy
+from django_session_jwt.revocation import CacheStore, DatabaseStore, RevocationList
+from django_session_jwt.test import CachedClient, Client, LoadHarness, TokenFactory
+from django_session_jwt.verifier import Verifier
+
+try:
+    from asgiref.sync import async_to_sync, sync_to_async
+    from django_session_jwt.middleware.asynchronous import AsyncSessionMiddleware
+
+except ImportError:
+    # asgiref is only available with Django 3.0+.
+    AsyncSessionMiddleware = None
 
 from freezegun import freeze_time
 
+import django
+import jwt as pyjwt
+
 User = get_user_model()
+# Async middleware requires Django 3.1+.
+ASYNC = AsyncSessionMiddleware is not None and django.VERSION >= (3, 1)
 
 
 class BaseTestCase(TestCase):
@@ -30,6 +73,25 @@ class BaseTestCase(TestCase):
         self.client = Client()
 
 
+class SessionHelpersMixin(object):
+    """
+    Patch middleware settings and count session backend queries.
+    """
+
+    def _patch_session(self, **values):
+        "Replace django_session_jwt.middleware.session globals for the test."
+        for name, value in values.items():
+            patcher = mock.patch.object(session, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _session_queries(self, func, *args):
+        "Return the result of func(*args) and the session backend queries it made."
+        with CaptureQueriesContext(connection) as queries:
+            r = func(*args)
+        return r, [q['sql'] for q in queries if 'django_session' in q['sql']]
+
+
 class JWTTestCase(BaseTestCase):
     """
     Test low-level JWT handling.
@@ -58,6 +120,1366 @@ class JWTTestCase(BaseTestCase):
             fields = session.verify_jwt(jwt)
             self.assertEqual(fields['sk'], session_key)
 
+    def _test_key_pair(self, name, expected):
+        key, pubkey, algo = session._parse_key((
+            normpath(pathjoin(dirname(__file__), '../keys/%s' % name)),
+            normpath(pathjoin(dirname(__file__), '../keys/%s.pub' % name))
+        ))
+        self.assertEqual(algo, expected)
+
+        with mock.patch('django_session_jwt.middleware.session.ALGO', algo), \
+             mock.patch('django_session_jwt.middleware.session.KEY', key), \
+             mock.patch('django_session_jwt.middleware.session.PUBKEY', pubkey):
+            jwt = session.create_jwt(self.user, '1234abcdef')
+            self.assertEqual(pyjwt.get_unverified_header(jwt)['alg'], expected)
+            self.assertEqual(session.verify_jwt(jwt)['sk'], '1234abcdef')
+
+    def test_eddsa(self):
+        "Test using Ed25519 key"
+        self._test_key_pair('ed25519', 'EdDSA')
+
+    def test_ecdsa(self):
+        "Test using P-256 key"
+        self._test_key_pair('ec', 'ES256')
+
+    def test_explicit_algo(self):
+        "Test overriding the detected algorithm"
+        _, _, algo = session._parse_key('secret', 'HS512')
+        self.assertEqual(algo, 'HS512')
+        _, _, algo = session._parse_key((
+            normpath(pathjoin(dirname(__file__), '../keys/rsa')),
+            normpath(pathjoin(dirname(__file__), '../keys/rsa.pub')),
+            'PS256',
+        ))
+        self.assertEqual(algo, 'PS256')
+
+    def test_verify_only(self):
+        "Test key pair without a private key"
+        key, _, algo = session._parse_key((
+            None, normpath(pathjoin(dirname(__file__), '../keys/rsa.pub'))))
+        self.assertIsNone(key)
+        self.assertEqual(algo, 'RS256')
+
+    def test_unsupported_algo(self):
+        "Test unknown algorithms are a configuration error"
+        with self.assertRaises(ImproperlyConfigured):
+            session._parse_key('secret', 'HS257')
+
+
+class FieldsTestCase(BaseTestCase):
+    """
+    Test compiled field extraction.
+    """
+
+    FIELDS = [
+        ('name', 'n', 'name'),
+        ('content_type.app_label', 'a', 'app_label'),
+        ('content_type.model', 'm', 'model'),
+        ('group_set.count', 'g', 'groups'),
+        ('codename.upper', 'c', 'codename'),
+    ]
+
+    def test_select_related(self):
+        "Test relations are joined for dotted attribute names"
+        self.assertEqual(session._select_related(self.FIELDS, Permission), ['content_type'])
+        self.assertEqual(session._select_related(self.FIELDS[:1], Permission), [])
+
+    def test_single_query(self):
+        "Test nested fields are read with one query"
+        getters = session._compile_fields(self.FIELDS[:3])
+        with self.assertNumQueries(1):
+            permission = Permission.objects.select_related(
+                *session._select_related(self.FIELDS, Permission)).first()
+            values = [getter(permission) for getter, _, _ in getters]
+        self.assertEqual(values[1], permission.content_type.app_label)
+
+    def test_user_queryset(self):
+        "Test users are fetched with the planned joins"
+        with mock.patch('django_session_jwt.middleware.session.FIELDS', self.FIELDS):
+            session._user_select_related.cache_clear()
+            self.addCleanup(session._user_select_related.cache_clear)
+            self.assertEqual(session._user_select_related(Permission), ['content_type'])
+        self.assertEqual(session.user_queryset().get(pk=self.user.pk), self.user)
+
+
+class ClaimsTestCase(BaseTestCase):
+    """
+    Test verified claims mapping.
+    """
+
+    def test_names(self):
+        "Test short and long names resolve to a single value"
+        fields = session.verify_jwt(session.create_jwt(self.user, '1234abcdef'))
+        self.assertEqual(fields.raw['u'], 'john')
+        self.assertNotIn('username', fields.raw)
+        self.assertEqual(fields['u'], fields['username'])
+        self.assertEqual(fields['id'], fields['user_id'])
+        self.assertEqual(dict(fields)['email'], 'john@domain.com')
+        self.assertEqual(len(fields), len(list(fields)))
+
+    def test_exclude(self):
+        "Test hidden names are left out, under both names"
+        fields = Claims({'sk': '1234abcdef', 'u': 'john'}, {'username': 'u'})
+        view = fields.exclude('sk', 'u')
+        self.assertEqual(view, {})
+        self.assertNotIn('username', view)
+        self.assertIs(view.raw, fields.raw)
+
+    def test_session(self):
+        "Test session['jwt'] holds the claims without the session key"
+        jwt = session.create_jwt(self.user, '1234abcdef')
+        request = RequestFactory().get('/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = jwt
+        session.SessionMiddleware(lambda r: None).process_request(request)
+        self.assertEqual(request.session._session_key, '1234abcdef')
+        self.assertNotIn('sk', request.session['jwt'])
+        self.assertEqual(request.session['jwt']['user_id'], self.user.pk)
+
+
+class KeyRingTestCase(BaseTestCase):
+    """
+    Test kid-indexed key rotation.
+    """
+
+    def setUp(self):
+        super(KeyRingTestCase, self).setUp()
+        self.keyring = session.KeyRing({
+            'a': 'a-secret-key-that-is-at-least-32-bytes',
+            'b': 'b-secret-key-that-is-at-least-32-bytes',
+        }, 'a')
+        patcher = mock.patch('django_session_jwt.middleware.session.KEYRING', self.keyring)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_prepared(self):
+        "Test RSA keys are parsed into key objects"
+        key, pubkey, _ = session._parse_key((
+            normpath(pathjoin(dirname(__file__), '../keys/rsa')),
+            normpath(pathjoin(dirname(__file__), '../keys/rsa.pub'))
+        ))
+        self.assertFalse(isinstance(key, (str, bytes)))
+        self.assertFalse(isinstance(pubkey, (str, bytes)))
+
+    def test_rotation(self):
+        "Test tokens are verified with the key named by kid"
+        jwt_a = session.create_jwt(self.user, '1234abcdef')
+        self.assertEqual(pyjwt.get_unverified_header(jwt_a)['kid'], 'a')
+
+        self.keyring.set_signing_key('b')
+        jwt_b = session.create_jwt(self.user, '1234abcdef')
+        self.assertEqual(pyjwt.get_unverified_header(jwt_b)['kid'], 'b')
+        self.assertEqual(session.verify_jwt(jwt_a)['sk'], '1234abcdef')
+        self.assertEqual(session.verify_jwt(jwt_b)['sk'], '1234abcdef')
+
+        self.keyring.remove('a')
+        self.assertEqual(session.verify_jwt(jwt_a), {})
+        self.assertEqual(session.verify_jwt(jwt_b)['sk'], '1234abcdef')
+
+    def test_no_kid(self):
+        "Test tokens without kid fall back to KEY"
+        jwt = pyjwt.encode({'sk': '1234abcdef'}, session.KEY, algorithm=session.ALGO)
+        self.assertEqual(session.verify_jwt(jwt)['sk'], '1234abcdef')
+
+    def test_malformed_header(self):
+        "Test tokens with an invalid kid or alg are rejected"
+        jwt = session.create_jwt(self.user, '1234abcdef')
+        _, payload, signature = jwt.split('.')
+        for header in ({'alg': 'HS256', 'kid': 123}, {'alg': 'none', 'kid': 'a'}):
+            header = base64.urlsafe_b64encode(json.dumps(header).encode()).rstrip(b'=')
+            blob = '.'.join((header.decode(), payload, signature))
+            self.assertEqual(session.verify_jwt(blob), {})
+            self.assertEqual(list(session.verify_jwt_many([blob])), [{}])
+
+    def test_loader(self):
+        "Test unknown kid reloads keys from the loader"
+        keys = {'c': 'c-secret-key-that-is-at-least-32-bytes'}
+        keyring = session.KeyRing(loader=lambda: keys, refresh_interval=0)
+        jwt = pyjwt.encode({'sk': '1234abcdef'}, keys['c'], headers={'kid': 'd'})
+        keys['d'] = keys.pop('c')
+        with mock.patch('django_session_jwt.middleware.session.KEYRING', keyring):
+            self.assertEqual(session.verify_jwt(jwt)['sk'], '1234abcdef')
+
+
+class CompactTestCase(BaseTestCase):
+    """
+    Test compressed payloads.
+    """
+
+    def setUp(self):
+        super(CompactTestCase, self).setUp()
+        claims = dict(('permission%02d' % i, 'app.change_model%02d' % i) for i in range(30))
+        patcher = mock.patch.object(session, 'CALLABLE', lambda user: claims)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_compact(self):
+        "Test compressed JWT is smaller and verifies"
+        plain = session.create_jwt(self.user, '1234abcdef')
+        with mock.patch.object(session, 'COMPACT', True):
+            jwt = session.create_jwt(self.user, '1234abcdef')
+
+        self.assertLess(len(jwt), len(plain) / 2)
+        self.assertEqual(pyjwt.get_unverified_header(jwt)['zip'], 'DEF')
+        # Verifying does not depend on COMPACT.
+        fields = session.verify_jwt(jwt)
+        self.assertEqual(fields['permission29'], 'app.change_model29')
+        self.assertEqual(fields['user_id'], self.user.pk)
+
+    def test_incompressible(self):
+        "Test payload is left alone when compressing does not help"
+        jwt = compact.CompactJWT().encode({'a': 1}, session.KEY, headers={})
+        self.assertNotIn('zip', pyjwt.get_unverified_header(jwt))
+        self.assertEqual(session.verify_jwt(jwt), {'a': 1})
+
+    def test_unsupported(self):
+        "Test unknown compression is rejected"
+        jwt = pyjwt.encode({'sk': '1234abcdef'}, session.KEY, headers={'zip': 'GZ'})
+        self.assertEqual(session.verify_jwt(jwt), {})
+
+    def test_size_budget(self):
+        "Test oversized JWT logs a warning"
+        with mock.patch.object(session, 'SIZE_BUDGET', 100), \
+             self.assertLogs(session.LOGGER, 'WARNING') as logs:
+            session.create_jwt(self.user, '1234abcdef')
+        self.assertIn('SIZE_BUDGET', logs.output[-1])
+
+
+class BatchTestCase(BaseTestCase):
+    """
+    Test bulk JWT signing and verification.
+    """
+
+    def test_many(self):
+        "Test JWTs are signed and verified in order"
+        jwts = list(session.create_jwt_many(
+            [(self.user, '1234abcdef'), (None, 'abcdef1234'), (self.user, 'abcdef5678')],
+            60, chunk_size=2))
+        self.assertIsNone(jwts[1])
+
+        fields = list(session.verify_jwt_many([jwts[0], 'garbage', jwts[2]], chunk_size=2))
+        self.assertEqual([f.get('sk') for f in fields], ['1234abcdef', None, 'abcdef5678'])
+        self.assertEqual(fields[0]['username'], 'john')
+
+    def test_processes(self):
+        "Test RSA signing and verification in worker processes"
+        key, pubkey, algo = session._parse_key((
+            normpath(pathjoin(dirname(__file__), '../keys/rsa')),
+            normpath(pathjoin(dirname(__file__), '../keys/rsa.pub'))
+        ))
+        with mock.patch.object(session, 'KEY', key), \
+             mock.patch.object(session, 'PUBKEY', pubkey), \
+             mock.patch.object(session, 'ALGO', algo), \
+             ProcessPoolExecutor(2) as executor:
+            pairs = ((self.user, 'session%04d' % i) for i in range(50))
+            jwts = list(session.create_jwt_many(pairs, 60, executor, chunk_size=8))
+            fields = list(session.verify_jwt_many(jwts, executor, chunk_size=8))
+
+        self.assertEqual(pyjwt.get_unverified_header(jwts[0])['alg'], 'RS256')
+        self.assertEqual([f['sk'] for f in fields], ['session%04d' % i for i in range(50)])
+
+    def test_reissue(self):
+        "Test JWTs are reissued with the current fields"
+        jwt = session.create_jwt(self.user, '1234abcdef', 60)
+        with mock.patch.object(session, 'CALLABLE', lambda user: {'v': 2}):
+            jwts = list(session.reissue_jwt_many([jwt, 'garbage']))
+            fields = session.verify_jwt(jwts[0])
+        self.assertIsNone(jwts[1])
+        self.assertEqual(fields['sk'], '1234abcdef')
+        self.assertEqual(fields['v'], 2)
+
+    def _call(self, *args, **kwargs):
+        stdout = StringIO()
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+            f.write(kwargs.get('input', ''))
+            f.flush()
+            call_command('session_jwt', *(args + ('--input', f.name, '--processes', '1')),
+                         stdout=stdout)
+        return stdout.getvalue().splitlines()
+
+    def test_command(self):
+        "Test minting, verifying and reissuing from files"
+        minted = self._call('mint', input='%d\n%d\n' % (self.user.pk, self.user.pk + 1))
+        self.assertEqual(minted[1], '%d ' % (self.user.pk + 1))
+        user_id, jwt = minted[0].split(' ')
+        self.assertEqual(int(user_id), self.user.pk)
+
+        verified = self._call('verify', input='%s\ngarbage\n' % jwt)
+        self.assertEqual(json.loads(verified[0])['username'], 'john')
+        self.assertEqual(json.loads(verified[1]), {})
+
+        reissued = self._call('reissue', input=jwt)
+        self.assertEqual(session.verify_jwt(reissued[0])['sk'], session.verify_jwt(jwt)['sk'])
+
+        # The output of mint is accepted as is.
+        verified = self._call('verify', input='\n'.join(minted))
+        self.assertEqual(json.loads(verified[0])['username'], 'john')
+        self.assertEqual(json.loads(verified[1]), {})
+
+
+class VerifierTestCase(BaseTestCase):
+    """
+    Test the Django-free verifier.
+    """
+
+    def test_no_django(self):
+        "Test the verifier does not import Django"
+        code = 'import sys, django_session_jwt.verifier; print("django" in sys.modules)'
+        output = subprocess.check_output(
+            [sys.executable, '-c', code], cwd=normpath(pathjoin(dirname(__file__), '..')))
+        self.assertEqual(output.strip(), b'False')
+
+    def test_from_config(self):
+        "Test verifying with explicit configuration"
+        key = (normpath(pathjoin(dirname(__file__), '../keys/rsa')),
+               normpath(pathjoin(dirname(__file__), '../keys/rsa.pub')))
+        key, _, algo = session._parse_key(key)
+        with mock.patch.object(session, 'KEY', key), \
+             mock.patch.object(session, 'ALGO', algo):
+            jwt = session.create_jwt(self.user, '1234abcdef')
+
+        verifier = Verifier.from_config(
+            (None, normpath(pathjoin(dirname(__file__), '../keys/rsa.pub'))),
+            fields=settings.DJANGO_SESSION_JWT['FIELDS'], cache_size=8)
+        fields = verifier.verify(jwt)
+        self.assertEqual(fields['username'], 'john')
+        self.assertEqual(fields['user_id'], self.user.pk)
+        self.assertIs(verifier.verify(jwt), fields)
+        self.assertEqual(verifier.verify(jwt + 'x'), {})
+
+    def test_revocations(self):
+        "Test revoked tokens are rejected"
+        jwt = session.create_jwt(self.user, '1234abcdef')
+        verifier = Verifier(session.PUBKEY, session.ALGO, revocations={'1234abcdef'})
+        self.assertEqual(verifier.verify(jwt), {})
+
+    def test_no_cache(self):
+        "Test clearing the cache of a verifier without one"
+        verifier = Verifier.from_config(settings.SECRET_KEY)
+        verifier.clear_cache()
+        jwt = session.create_jwt(self.user, '1234abcdef')
+        self.assertEqual(verifier.verify(jwt)['sk'], '1234abcdef')
+
+
+class CacheTestCase(BaseTestCase):
+    """
+    Test verified token cache.
+    """
+
+    def setUp(self):
+        super(CacheTestCase, self).setUp()
+        patcher = mock.patch('django_session_jwt.middleware.session.CACHE', LRUCache(8))
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_hit(self):
+        "Test repeated token is served from cache"
+        jwt = session.create_jwt(self.user, '1234abcdef', 60)
+        fields1 = session.verify_jwt(jwt)
+        fields2 = session.verify_jwt(jwt)
+        self.assertEqual(fields1, fields2)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+        # Claims are read-only, so the cached instance is shared.
+        self.assertIs(fields1, fields2)
+        with self.assertRaises(TypeError):
+            fields2['sk'] = 'abcdef1234'
+
+    def test_expired(self):
+        "Test expired token is evicted from cache"
+        with freeze_time('2020-01-01T09:00:00'):
+            jwt = session.create_jwt(self.user, '1234abcdef', 60)
+            self.assertTrue(session.verify_jwt(jwt))
+
+        with freeze_time('2020-01-01T09:05:00'):
+            self.assertEqual(session.verify_jwt(jwt), {})
+        self.assertEqual(len(self.cache), 0)
+
+    def test_key_change(self):
+        "Test cache is cleared when verification key changes"
+        jwt = session.create_jwt(self.user, '1234abcdef')
+        self.assertTrue(session.verify_jwt(jwt))
+
+        with mock.patch('django_session_jwt.middleware.session.PUBKEY', 'another-secret-key-of-sufficient-length'):
+            self.assertEqual(session.verify_jwt(jwt), {})
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_lru(self):
+        "Test least recently used token is evicted"
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+
+class SharedCacheTestCase(BaseTestCase):
+    """
+    Test the verified token cache shared between processes.
+    """
+
+    def setUp(self):
+        super(SharedCacheTestCase, self).setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = pathjoin(tmp.name, 'verified')
+        self.cache = SharedCache(self.path, 16)
+        self.addCleanup(self.cache.close)
+
+    def _verifier(self, events):
+        # Each Verifier stands in for a worker process.
+        return Verifier(
+            session.PUBKEY, session.ALGO, shared_cache=SharedCache(self.path),
+            metrics=lambda event, duration: events.append(event))
+
+    def test_slots(self):
+        "Test lookups, expiry and torn slots"
+        digest = SharedCache.digest(b'key', 'token')
+        self.assertFalse(self.cache.get(digest))
+        self.cache.set(digest, time.time() + 60)
+        self.assertTrue(self.cache.get(digest))
+        self.assertFalse(self.cache.get(SharedCache.digest(b'other', 'token')))
+
+        # Same file, same slots.
+        other = SharedCache(self.path, 1024)
+        self.addCleanup(other.close)
+        self.assertEqual(other.slots, 16)
+        self.assertTrue(other.get(digest))
+
+        # A half written slot is a miss.
+        offset = self.cache._offset(digest)
+        self.cache._map[offset + 32:offset + 40] = bytes(8)
+        self.assertFalse(other.get(digest))
+
+        self.cache.set(digest, time.time() - 1)
+        self.assertFalse(self.cache.get(digest))
+        self.cache.set(digest)
+        self.assertTrue(self.cache.get(digest))
+
+    def test_permissions(self):
+        "Test files others can access, or symlinks, are refused"
+        os.chmod(self.path, 0o666)
+        with self.assertRaises(ImproperlyConfigured):
+            session._parse_shared_cache(self.path, 16)
+
+        os.chmod(self.path, 0o600)
+        link = self.path + '.link'
+        os.symlink(self.path, link)
+        with self.assertRaises(ImproperlyConfigured):
+            session._parse_shared_cache(link, 16)
+
+        with mock.patch('os.geteuid', return_value=os.geteuid() + 1):
+            with self.assertRaises(ImproperlyConfigured):
+                session._parse_shared_cache(self.path, 16)
+
+        session._parse_shared_cache(self.path, 16).close()
+
+    def test_verify(self):
+        "Test tokens verified by one process are not verified again by others"
+        jwt = session.create_jwt(self.user, '1234abcdef', 60)
+        events1, events2 = [], []
+        fields = self._verifier(events1).verify(jwt)
+        with mock.patch.object(pyjwt.algorithms.HMACAlgorithm, 'verify') as verify:
+            self.assertEqual(self._verifier(events2).verify(jwt), fields)
+        verify.assert_not_called()
+        self.assertEqual((events1, events2), (['verify.ok'], ['verify.shared']))
+
+        # Still checked: tampering, expiry and the verification key.
+        self.assertEqual(self._verifier([]).verify(jwt[:-2]), {})
+        with freeze_time(datetime.utcnow() + timedelta(seconds=120)):
+            self.assertEqual(self._verifier(events2).verify(jwt), {})
+        self.assertEqual(events2[-1], 'verify.expired')
+        verifier = self._verifier(events2)
+        verifier.pubkey = b'another key' * 4
+        self.assertEqual(verifier.verify(jwt), {})
+        self.assertEqual(events2[-1], 'verify.invalid')
+
+    def test_key_pairs(self):
+        "Test tokens signed with RSA, EC and Ed25519 keys are shared"
+        for name in ('rsa', 'ec', 'ed25519'):
+            with self.subTest(name):
+                key, pubkey, algo = session._parse_key((
+                    normpath(pathjoin(dirname(__file__), '../keys/%s' % name)),
+                    normpath(pathjoin(dirname(__file__), '../keys/%s.pub' % name))))
+                with mock.patch.object(session, 'KEY', key), \
+                     mock.patch.object(session, 'PUBKEY', pubkey), \
+                     mock.patch.object(session, 'ALGO', algo), \
+                     mock.patch.object(session, 'SHARED_CACHE', self.cache):
+                    jwt = session.create_jwt(self.user, '1234abcdef', 60)
+                    self.assertEqual(session.verify_jwt(jwt)['sk'], '1234abcdef')
+
+                events = []
+                verifier = Verifier(
+                    pubkey, algo, shared_cache=SharedCache(self.path),
+                    metrics=lambda event, duration: events.append(event))
+                self.assertEqual(verifier.verify(jwt)['sk'], '1234abcdef')
+                self.assertEqual(events, ['verify.shared'])
+
+    def test_settings(self):
+        "Test verify_jwt() uses SHARED_CACHE"
+        jwt = session.create_jwt(self.user, '1234abcdef')
+        with mock.patch.object(session, 'SHARED_CACHE', self.cache):
+            session.verify_jwt(jwt)
+        self.assertTrue(self.cache.get(SharedCache.digest(
+            session._verifier().fingerprint(session.PUBKEY, session.ALGO), jwt)))
+
+        with self.assertRaises(ImproperlyConfigured):
+            session._parse_shared_cache(pathjoin(self.path, 'missing', 'file'), 16)
+
+
+class CallableCacheTestCase(SessionHelpersMixin, BaseTestCase):
+    """
+    Test cached CALLABLE results.
+    """
+
+    def setUp(self):
+        super(CallableCacheTestCase, self).setUp()
+        self.calls = []
+
+        def claims(user):
+            self.calls.append(user.pk)
+            return {'groups': [g.name for g in user.groups.all()]}
+
+        self._patch_session(
+            CALLABLE=claims, CALLABLE_CACHE=LRUCache(8),
+            CALLABLE_CACHE_MODELS=frozenset(['auth.User', 'auth.Group']))
+
+        session._connect_invalidation(['auth.User', 'auth.Group'])
+        self.addCleanup(self._disconnect)
+
+    def _disconnect(self):
+        for model in (User, Group):
+            post_save.disconnect(session._invalidate_instance, sender=model)
+            post_delete.disconnect(session._invalidate_instance, sender=model)
+        m2m_changed.disconnect(session._invalidate_m2m)
+
+    def test_cached(self):
+        "Test CALLABLE is called once per user"
+        session.user_fields(self.user)
+        fields = session.user_fields(self.user)
+        self.assertEqual(fields['groups'], [])
+        self.assertEqual(self.calls, [self.user.pk])
+
+    def test_ttl(self):
+        "Test cached result expires"
+        with freeze_time('2020-01-01T09:00:00'):
+            session.user_fields(self.user)
+        with freeze_time('2020-01-01T09:05:00'):
+            session.user_fields(self.user)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_save(self):
+        "Test saving the user invalidates its result"
+        session.user_fields(self.user)
+        self.user.first_name = 'John'
+        self.user.save()
+        session.user_fields(self.user)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_m2m(self):
+        "Test group membership changes invalidate results"
+        group = Group.objects.create(name='staff')
+        session.user_fields(self.user)
+
+        self.user.groups.add(group)
+        self.assertEqual(session.user_fields(self.user)['groups'], ['staff'])
+
+        group.user_set.remove(self.user)
+        self.assertEqual(session.user_fields(self.user)['groups'], [])
+        self.assertEqual(len(self.calls), 3)
+
+    def test_invalidate(self):
+        "Test explicit invalidation"
+        session.user_fields(self.user)
+        session.invalidate_fields(self.user.pk)
+        session.user_fields(self.user)
+        session.invalidate_fields()
+        session.user_fields(self.user)
+        self.assertEqual(len(self.calls), 3)
+
+
+class RevocationTestCase(BaseTestCase):
+    """
+    Test JWT revocation.
+    """
+
+    def setUp(self):
+        super(RevocationTestCase, self).setUp()
+        self.revocations = RevocationList(DatabaseStore(), 60)
+        # Synced, the background sync is not due during the test.
+        self.revocations.sync()
+        patcher = mock.patch.object(session, 'REVOCATIONS', self.revocations)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_revoke(self):
+        "Test revoked session is rejected"
+        jwt = session.create_jwt(self.user, '1234abcdef', 60)
+        other = session.create_jwt(self.user, 'abcdef1234', 60)
+        fields = session.verify_jwt(jwt)
+        session.revoke_jwt(fields.exclude('sk'))
+
+        self.assertEqual(session.verify_jwt(jwt), {})
+        self.assertEqual(session.verify_jwt(other)['sk'], 'abcdef1234')
+        self.assertEqual(RevokedToken.objects.get().expires, fields['exp'])
+
+    def test_cached(self):
+        "Test revocation applies to cached tokens"
+        jwt = session.create_jwt(self.user, '1234abcdef', 60)
+        with mock.patch.object(session, 'CACHE', LRUCache(8)):
+            session.revoke_jwt(session.verify_jwt(jwt))
+            self.assertEqual(session.verify_jwt(jwt), {})
+
+    def test_jti(self):
+        "Test revoking a single JWT by id"
+        with mock.patch.object(session, 'REVOCATION_CLAIM', 'jti'):
+            jwt1 = session.create_jwt(self.user, '1234abcdef', 60)
+            jwt2 = session.create_jwt(self.user, '1234abcdef', 60)
+            session.revoke_jwt(session.verify_jwt(jwt1))
+            self.assertEqual(session.verify_jwt(jwt1), {})
+            self.assertEqual(session.verify_jwt(jwt2)['sk'], '1234abcdef')
+
+    def _test_sync(self, store):
+        local = RevocationList(store, 60)
+        remote = RevocationList(store, 60)
+        local.sync()
+        remote.sync()
+        self.assertNotIn('1234abcdef', remote)
+
+        local.revoke('1234abcdef', time.time() + 60)
+        local.revoke('abcdef1234', time.time() - 1)
+        self.assertIn('1234abcdef', local)
+        # Not synced yet.
+        self.assertNotIn('1234abcdef', remote)
+
+        remote.sync()
+        self.assertIn('1234abcdef', remote)
+        remote.sync()
+        self.assertEqual(len(remote), 1)
+
+    def test_sync_database(self):
+        "Test revocations are shared through the database"
+        self._test_sync(DatabaseStore())
+        DatabaseStore().prune()
+        self.assertEqual(RevokedToken.objects.count(), 1)
+
+    def test_sync_cache(self):
+        "Test revocations are shared through the cache"
+        self._test_sync(CacheStore(prefix='test-revoked'))
+
+    def test_cache_gap(self):
+        "Test entries numbered but not yet written are picked up later"
+        store = CacheStore(prefix='test-gap')
+        store.cache.add(store._key(0), 0, None)
+        n = store.cache.incr(store._key(0))  # Still being written.
+        store.add('abcdef1234')
+
+        entries, cursor = store.changes(None)
+        self.assertEqual(entries, [('abcdef1234', None)])
+        self.assertEqual(cursor, 0)
+
+        store.cache.set(store._key(n), ('1234abcdef', None))
+        entries, cursor = store.changes(cursor)
+        self.assertIn(('1234abcdef', None), entries)
+        self.assertEqual(cursor, 2)
+
+    def test_cache_lost(self):
+        "Test entries that never appear are skipped after the grace period"
+        store = CacheStore(prefix='test-lost', grace=10)
+        store.cache.add(store._key(0), 0, None)
+        store.cache.incr(store._key(0))
+        store.add('abcdef1234')
+        with freeze_time('2020-01-01T09:00:00'):
+            self.assertEqual(store.changes(None)[1], 0)
+        with freeze_time('2020-01-01T09:00:11'):
+            self.assertEqual(store.changes(0)[1], 2)
+
+
+    def test_database_gap(self):
+        "Test rows committed out of primary key order are picked up later"
+        store = DatabaseStore(grace=10)
+        first = RevokedToken.objects.create(value='first')
+        # Not committed yet.
+        pending = RevokedToken.objects.create(value='1234abcdef')
+        RevokedToken.objects.filter(pk=pending.pk).delete()
+        RevokedToken.objects.create(value='abcdef1234')
+
+        with freeze_time('2020-01-01T09:00:00'):
+            entries, cursor = store.changes(first.pk - 1)
+        self.assertEqual(entries, [('first', None), ('abcdef1234', None)])
+        self.assertEqual(cursor, first.pk)
+
+        RevokedToken.objects.create(pk=pending.pk, value='1234abcdef')
+        with freeze_time('2020-01-01T09:00:05'):
+            entries, cursor = store.changes(cursor)
+        self.assertIn(('1234abcdef', None), entries)
+        self.assertEqual(cursor, pending.pk + 1)
+
+    def test_database_lost(self):
+        "Test rows that never commit are skipped after the grace period"
+        store = DatabaseStore(grace=10)
+        lost = RevokedToken.objects.create(value='rolled back')
+        RevokedToken.objects.filter(pk=lost.pk).delete()
+        last = RevokedToken.objects.create(value='abcdef1234')
+        with freeze_time('2020-01-01T09:00:00'):
+            self.assertEqual(store.changes(lost.pk - 1)[1], lost.pk - 1)
+        with freeze_time('2020-01-01T09:00:11'):
+            self.assertEqual(store.changes(lost.pk - 1)[1], last.pk)
+
+
+class LazySessionTestCase(BaseTestCase):
+    """
+    Test deferred session store construction.
+    """
+
+    def setUp(self):
+        super(LazySessionTestCase, self).setUp()
+        self.middleware = session.SessionMiddleware(lambda r: None)
+        self.request = RequestFactory().get('/')
+        self.request.COOKIES[settings.SESSION_COOKIE_NAME] = session.create_jwt(
+            self.user, '1234abcdef')
+        self.middleware.process_request(self.request)
+
+    def test_jwt_only(self):
+        "Test reading JWT fields does not create the session store"
+        self.assertEqual(self.request.session['jwt']['username'], 'john')
+        self.assertTrue('jwt' in self.request.session)
+        self.assertIsNone(self.request.session._store)
+        self.assertTrue(self.request.session.accessed)
+        self.assertFalse(self.request.session.modified)
+
+    def test_existing_session(self):
+        "Test sessions saved by the session engine can be read"
+        store = SessionStore()
+        store['a'] = 1
+        store.save()
+        self.request.COOKIES[settings.SESSION_COOKIE_NAME] = session.create_jwt(
+            self.user, store.session_key)
+        self.middleware.process_request(self.request)
+        self.assertEqual(self.request.session['a'], 1)
+
+    def test_session_access(self):
+        "Test other keys are delegated to the session store"
+        self.request.session['a'] = 1
+        self.assertIsNotNone(self.request.session._store)
+        self.assertEqual(self.request.session['a'], 1)
+        self.assertTrue(self.request.session.modified)
+        self.assertEqual(self.request.session['jwt']['username'], 'john')
+
+        self.request.session.flush()
+        self.assertIsNone(self.request.session.get('jwt'))
+
+
+class MetricsTestCase(BaseTestCase):
+    """
+    Test instrumentation hooks.
+    """
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        patcher = mock.patch('django_session_jwt.middleware.session.METRICS')
+        self.metrics = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def events(self):
+        return [c[0][0] for c in self.metrics.call_args_list]
+
+    def test_verify(self):
+        "Test verification outcomes are reported"
+        with freeze_time('2020-01-01T09:00:00'):
+            jwt = session.create_jwt(self.user, '1234abcdef', 60)
+            session.verify_jwt(jwt)
+            session.verify_jwt(jwt + 'x')
+        with freeze_time('2020-01-01T09:05:00'):
+            session.verify_jwt(jwt)
+        self.assertEqual(
+            self.events(), ['encode', 'verify.ok', 'verify.invalid', 'verify.expired'])
+        self.assertIsInstance(self.metrics.call_args_list[0][0][1], float)
+
+    def test_request(self):
+        "Test request stages are reported"
+        self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        events = self.events()
+        self.assertIn('session_save', events)
+        self.assertIn('reissue', events)
+        self.assertNotIn('refresh', events)
+
+    def test_statsd(self):
+        "Test statsd adapter"
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+        statsd = StatsdMetrics(*server.getsockname(), prefix='jwt')
+
+        statsd('reissue')
+        self.assertEqual(server.recv(1024), b'jwt.reissue:1|c')
+        statsd('encode', 0.0015)
+        self.assertEqual(server.recv(1024), b'jwt.encode:1.500|ms')
+
+
+@skipUnless(ASYNC, 'requires Django 3.1+')
+class AsyncMiddlewareTestCase(BaseTestCase):
+    """
+    Test native async middleware.
+    """
+
+    def run_request(self, request, view, auth=True):
+        async def handler(request):
+            return await sync_to_async(view)(request)
+
+        if auth:
+            handler = AuthenticationMiddleware(handler)
+        return async_to_sync(AsyncSessionMiddleware(handler))(request)
+
+    def make_request(self):
+        self.client.login(username='john', password='password')
+        request = RequestFactory().get('/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = \
+            self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        return request
+
+    def test_read(self):
+        "Test JWT fields are available without reissuing"
+        request = self.make_request()
+        r = self.run_request(request, views.claims)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.content)['username'], 'john')
+        self.assertIsNone(r.cookies.get(settings.SESSION_COOKIE_NAME))
+
+    def test_write(self):
+        "Test session write reissues the JWT"
+        request = self.make_request()
+        request.POST = {'a': '12345'}
+        r = self.run_request(request, views.set)
+        self.assertEqual(r.status_code, 200)
+        fields = session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertEqual(fields['username'], 'john')
+        self.assertEqual(SessionStore(fields['sk']).load()['a'], '12345')
+
+    def test_inactive(self):
+        "Test JWTs are not reissued with deactivated users"
+        request = self.make_request()
+        request.POST = {'a': '12345'}
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        r = self.run_request(request, views.set, auth=False)
+        fields = session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertNotIn('user_id', fields)
+
+    def test_no_auth_middleware(self):
+        "Test the user is looked up by the JWT without request.user"
+        request = self.make_request()
+        request.POST = {'a': '12345'}
+        r = self.run_request(request, views.set, auth=False)
+        fields = session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertEqual(fields['username'], 'john')
+
+    def test_revoked(self):
+        "Test revocations from other processes are synced off the event loop"
+        store = CacheStore(prefix='test-async-revoked')
+        revocations = RevocationList(store, 60)
+        request = self.make_request()
+        store.add(session.verify_jwt(request.COOKIES[settings.SESSION_COOKIE_NAME])['sk'])
+
+        threads = []
+
+        def changes(cursor, changes=store.changes):
+            threads.append(threading.current_thread())
+            return changes(cursor)
+
+        with mock.patch.object(session, 'REVOCATIONS', revocations), \
+             mock.patch.object(store, 'changes', changes):
+            # The request starts the sync, but does not wait for it.
+            self.run_request(request, views.claims)
+            revocations._thread.join()
+            self.assertEqual(threads, [revocations._thread])
+
+            r = self.run_request(request, views.claims)
+            self.assertEqual(json.loads(r.content), {})
+
+    def test_executor(self):
+        "Test crypto is offloaded to the executor"
+        executor = ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        request = self.make_request()
+        request.POST = {'a': '12345'}
+        with mock.patch.object(AsyncSessionMiddleware, 'executor', executor), \
+             mock.patch.object(executor, 'submit', wraps=executor.submit) as submit:
+            r = self.run_request(request, views.set)
+        # Only verification and signing, not the claims (database queries).
+        self.assertEqual(
+            [call[0][0].func for call in submit.call_args_list],
+            [session.verify_jwt, session._encode])
+        fields = session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertEqual(fields['username'], 'john')
+
+
+@override_settings(MIDDLEWARE=[
+    m.replace('django.contrib.auth.middleware.AuthenticationMiddleware',
+              'django_session_jwt.auth.JWTAuthenticationMiddleware')
+    for m in settings.MIDDLEWARE
+])
+class JWTAuthenticationTestCase(BaseTestCase):
+    """
+    Test request.user populated from the JWT.
+    """
+
+    def test_no_queries(self):
+        "Test JWT fields are served without loading the user"
+        self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        with self.assertNumQueries(0):
+            r = self.client.get('/user/')
+        self.assertEqual(r.json(), {'username': 'john', 'email': 'john@domain.com'})
+
+    def test_deferred(self):
+        "Test fields not in the JWT are loaded on use"
+        user = user_from_jwt({'user_id': self.user.pk, 'username': 'john'})
+        with self.assertNumQueries(0):
+            self.assertIsInstance(user, User)
+            self.assertTrue(user.is_authenticated)
+            self.assertEqual(user.pk, self.user.pk)
+            self.assertEqual(user.username, 'john')
+            self.assertEqual(user, self.user)
+        with self.assertNumQueries(1):
+            self.assertFalse(user.is_staff)
+        with self.assertNumQueries(1):
+            self.assertTrue(user.check_password('password'))
+
+    def test_reissue_checks_user(self):
+        "Test JWTs are only reissued for active users with the same password"
+        self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        r = self.client.post('/set/', {'a': '12345'})
+        self.assertEqual(self._reissued(r)['username'], 'john')
+
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertNotIn('user_id', self._reissued(self.client.post('/set/', {'a': 'abcde'})))
+
+        User.objects.filter(pk=self.user.pk).update(is_active=True)
+        self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        self.user.set_password('changed')
+        self.user.save()
+        self.assertNotIn('user_id', self._reissued(self.client.post('/set/', {'a': '12345'})))
+
+    def _reissued(self, r):
+        return session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+
+    def test_replay_after_logout(self):
+        "Test a JWT copied before logging out is not refreshed with the user"
+        name = settings.SESSION_COOKIE_NAME
+        with freeze_time('2020-01-01T09:00:00'):
+            self.client.post('/login/', {'username': 'john', 'password': 'password'})
+            jwt = self.client.cookies[name].value
+            self.client.post('/logout/')
+
+        replay = Client()
+        for now in ('2020-01-01T14:00:00', '2020-01-01T19:00:00', '2020-01-01T23:00:00'):
+            replay.cookies[name] = jwt
+            with freeze_time(now):
+                r = replay.get('/claims/')
+            if name in r.cookies:
+                jwt = r.cookies[name].value
+                with freeze_time(now):
+                    self.assertNotIn('user_id', session.verify_jwt(jwt))
+
+        # The copy was only usable until it expired.
+        with freeze_time('2020-01-01T19:00:00'):
+            self.assertNotIn('user_id', session.verify_jwt(jwt))
+
+    def test_model_instance(self):
+        "Test the user can be used in relations and queries"
+        user = user_from_jwt({'user_id': self.user.pk, 'username': 'john'})
+        group = Group.objects.create(name='staff')
+        group.user_set.add(user)
+        self.assertEqual(User.objects.get(groups=group), self.user)
+        self.assertEqual(Group.objects.filter(user=user).get(), group)
+
+    def test_anonymous(self):
+        "Test requests without a JWT fall back to contrib.auth"
+        request = RequestFactory().get('/')
+        session.SessionMiddleware(lambda r: None).process_request(request)
+        JWTAuthenticationMiddleware(lambda r: None).process_request(request)
+        self.assertFalse(request.user.is_authenticated)
+
+
+@override_settings(SESSION_SAVE_EVERY_REQUEST=True)
+@mock.patch('django_session_jwt.middleware.session.REUSE_UNCHANGED', True)
+class ReuseTestCase(BaseTestCase):
+    """
+    Test sending the unchanged JWT instead of signing a new one.
+    """
+
+    def login(self):
+        r = self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        return r.cookies[settings.SESSION_COOKIE_NAME].value
+
+    def test_unchanged(self):
+        "Test unchanged fields reuse the JWT"
+        with freeze_time('2020-01-01T09:00:00'):
+            jwt = self.login()
+        with freeze_time('2020-01-01T09:05:00'):
+            r = self.client.get('/get/')
+        self.assertEqual(r.cookies[settings.SESSION_COOKIE_NAME].value, jwt)
+
+    def test_changed(self):
+        "Test changed fields issue a new JWT"
+        with freeze_time('2020-01-01T09:00:00'):
+            jwt = self.login()
+        User.objects.filter(pk=self.user.pk).update(email='jane@domain.com')
+        with freeze_time('2020-01-01T09:05:00'):
+            r = self.client.get('/get/')
+            jwt2 = r.cookies[settings.SESSION_COOKIE_NAME].value
+            self.assertEqual(session.verify_jwt(jwt2)['email'], 'jane@domain.com')
+        self.assertNotEqual(jwt, jwt2)
+
+    def test_refresh(self):
+        "Test JWT in the refresh window is signed again"
+        with freeze_time('2020-01-01T09:00:00'):
+            jwt = self.login()
+        with freeze_time('2020-01-01T13:05:00'):
+            r = self.client.get('/get/')
+            self.assertNotEqual(r.cookies[settings.SESSION_COOKIE_NAME].value, jwt)
+
+
+class TrustedProxyTestCase(SessionHelpersMixin, BaseTestCase):
+    """
+    Test claims forwarded by a trusted proxy.
+    """
+
+    KEY = b'proxy-secret-of-sufficient-length'
+
+    def setUp(self):
+        super(TrustedProxyTestCase, self).setUp()
+        self._patch_session(
+            TRUSTED_PROXIES=forwarding.parse_networks(['10.0.0.0/8']), TRUSTED_KEY=self.KEY)
+        self.jwt = session.create_jwt(self.user, '1234abcdef', 60)
+        self.claims = dict(session.verify_jwt(self.jwt).raw)
+
+    def _request(self, header, address='10.1.2.3'):
+        request = RequestFactory().get(
+            '/', REMOTE_ADDR=address, HTTP_X_JWT_CLAIMS=header)
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = self.jwt
+        with mock.patch.object(session, 'verify_jwt', wraps=session.verify_jwt) as verify:
+            session.SessionMiddleware(lambda r: None).process_request(request)
+        return request, verify.called
+
+    def test_forwarded(self):
+        "Test forwarded claims are used without verifying the JWT"
+        request, verified = self._request(forwarding.sign(self.KEY, self.jwt, self.claims))
+        self.assertFalse(verified)
+        self.assertEqual(request.session._session_key, '1234abcdef')
+        self.assertEqual(request.session['jwt']['username'], 'john')
+
+    def test_untrusted(self):
+        "Test forwarded claims from other addresses are ignored"
+        header = forwarding.sign(self.KEY, self.jwt, dict(self.claims, u='jane'))
+        request, verified = self._request(header, '192.168.1.1')
+        self.assertTrue(verified)
+        self.assertEqual(request.session['jwt']['username'], 'john')
+
+    def test_invalid(self):
+        "Test invalid or mismatched forwarded claims fall back to verification"
+        for header in (
+                forwarding.sign(b'another-secret', self.jwt, dict(self.claims, u='jane')),
+                forwarding.sign(self.KEY, self.jwt + 'x', dict(self.claims, u='jane')),
+                'garbage'):
+            request, verified = self._request(header)
+            self.assertTrue(verified)
+            self.assertEqual(request.session['jwt']['username'], 'john')
+
+    def test_expired(self):
+        "Test expired forwarded claims are rejected"
+        header = forwarding.sign(self.KEY, self.jwt, dict(self.claims, exp=time.time() - 1))
+        request, verified = self._request(header)
+        self.assertFalse(verified)
+        self.assertIsNone(request.session.jwt)
+
+
+class RefreshTestCase(BaseTestCase):
+    """
+    Test JWT refresh scheduling.
+    """
+
+    def test_window(self):
+        "Test refresh is due in the last part of the JWT's own lifetime"
+        policy = RefreshPolicy(window=0.25)
+        fields = {'iat': 1000, 'exp': 2000}
+        self.assertFalse(policy.due(fields, now=1749))
+        self.assertTrue(policy.due(fields, now=1750))
+        self.assertFalse(policy.due({'iat': 1000}, now=5000))
+
+    def test_jitter(self):
+        "Test jitter is deterministic per session and spreads refreshes"
+        policy = RefreshPolicy(window=0.5, jitter=0.2)
+        fields = {'iat': 0, 'exp': 1000}
+        times = [policy.refresh_at(fields, 'session%d' % i) for i in range(100)]
+        self.assertEqual(times[0], policy.refresh_at(fields, 'session0'))
+        self.assertTrue(all(300 < t <= 500 for t in times))
+        self.assertGreater(len(set(times)), 90)
+        self.assertEqual(policy.refresh_at(fields, None), 500)
+
+    def test_refresh_unmodified(self):
+        "Test JWT is refreshed without a session modification"
+        with freeze_time('2020-01-01T09:00:00'):
+            r = self.client.post('/login/', {'username': 'john', 'password': 'password'})
+            jwt1 = session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+
+        with freeze_time('2020-01-01T09:05:00'):
+            r = self.client.get('/claims/')
+            self.assertIsNone(r.cookies.get(settings.SESSION_COOKIE_NAME))
+
+        with freeze_time('2020-01-01T16:00:00'):
+            r = self.client.get('/claims/')
+            jwt2 = session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertEqual(jwt1['sk'], jwt2['sk'])
+        self.assertGreater(jwt2['exp'], jwt1['exp'])
+
+
+class StatelessTestCase(SessionHelpersMixin, BaseTestCase):
+    """
+    Test session data carried in the JWT.
+    """
+
+    def setUp(self):
+        super(StatelessTestCase, self).setUp()
+        self._patch_session(STATELESS=True)
+
+    def test_anonymous(self):
+        "Test new sessions do not touch the backend"
+        r, queries = self._session_queries(self.client.post, '/set/', {'a': '12345'})
+        self.assertEqual(queries, [])
+        fields = session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertEqual(fields['sd'], {'a': '12345'})
+        self.assertEqual(len(fields['sk']), 32)
+        self.assertEqual(self.client.session['a'], '12345')
+
+        r, queries = self._session_queries(self.client.get, '/get/')
+        self.assertEqual(queries, [])
+        self.assertEqual(r.json(), {'a': '12345'})
+
+    def test_login(self):
+        "Test authenticated sessions are served from the JWT"
+        self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        self.client.post('/set/', {'a': '12345'})
+        r, queries = self._session_queries(self.client.get, '/user/')
+        self.assertEqual(queries, [])
+        self.assertEqual(r.json()['username'], 'john')
+        self.assertNotIn('sd', self.client.session.get('jwt', {}))
+
+    def test_spill(self):
+        "Test data over the budget is saved to the backend"
+        self.client.post('/set/', {'a': '12345'})
+        r = self.client.post('/set/', {'b': 'x' * 1024})
+        fields = session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertNotIn('sd', fields)
+        self.assertEqual(SessionStore(fields['sk'])['a'], '12345')
+
+        r, queries = self._session_queries(self.client.get, '/get/')
+        self.assertNotEqual(queries, [])
+        self.assertEqual(r.json()['b'], 'x' * 1024)
+
+    def test_login_logout(self):
+        "Test logging in and out does not touch the backend"
+        self.client.post('/set/', {'a': '12345'})
+        _, queries = self._session_queries(
+            self.client.post, '/login/', {'username': 'john', 'password': 'password'})
+        self.assertEqual(queries, [])
+        self.assertEqual(self.client.get('/get/').json()['a'], '12345')
+
+        _, queries = self._session_queries(self.client.post, '/logout/')
+        self.assertEqual(queries, [])
+        self.assertEqual(self.client.get('/get/').json(), {})
+
+    def test_login_spilled(self):
+        "Test logging in with data saved to the backend"
+        self.client.post('/set/', {'b': 'x' * 1024})
+        self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        r = self.client.get('/get/')
+        self.assertEqual(r.json()['b'], 'x' * 1024)
+        self.assertEqual(r.json()['_auth_user_id'], str(self.user.pk))
+
+    def test_logout_revokes(self):
+        "Test the JWT from before logging out can not be replayed"
+        revocations = RevocationList(DatabaseStore(), 60)
+        revocations.sync()
+        with mock.patch.object(session, 'REVOCATIONS', revocations):
+            self.client.post('/login/', {'username': 'john', 'password': 'password'})
+            jwt = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+            self.client.post('/logout/')
+            self.assertEqual(session.verify_jwt(jwt), {})
+
+            self.client.cookies[settings.SESSION_COOKIE_NAME] = jwt
+            self.assertNotIn('_auth_user_id', self.client.get('/get/').json())
+
+    def test_reissue_many(self):
+        "Test session data and version are kept when reissuing in bulk"
+        fields = dict(session.user_fields(self.user), sd={'_auth_user_id': str(self.user.pk)}, sv=3)
+        jwt = session.create_jwt(self.user, 'abcdef1234', 60, fields)
+        reissued = session.verify_jwt(list(session.reissue_jwt_many([jwt]))[0])
+        self.assertEqual(reissued['sd'], {'_auth_user_id': str(self.user.pk)})
+        self.assertEqual(reissued['sv'], 3)
+        self.assertEqual(reissued['sk'], 'abcdef1234')
+
+    def test_disabled(self):
+        "Test data from the JWT moves to the backend when disabled"
+        self.client.post('/set/', {'a': '12345'})
+        with mock.patch.object(session, 'STATELESS', False):
+            r = self.client.post('/set/', {'b': 'abcde'})
+        fields = session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertNotIn('sd', fields)
+        self.assertEqual(dict(SessionStore(fields['sk']).items()), {'a': '12345', 'b': 'abcde'})
+
+
+@override_settings(SESSION_ENGINE='django_session_jwt.backends.tiered')
+class TieredTestCase(SessionHelpersMixin, BaseTestCase):
+    """
+    Test the two-tier session engine.
+    """
+
+    def setUp(self):
+        super(TieredTestCase, self).setUp()
+        tiered.SessionStore.local.clear()
+        self.addCleanup(tiered.SessionStore.local.clear)
+
+    def _fields(self, r):
+        return session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+
+    def test_local(self):
+        "Test reads of the version in the JWT are served from memory"
+        self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        r = self.client.post('/set/', {'a': '12345'})
+        fields = self._fields(r)
+        self.assertEqual(dict(SessionStore(fields['sk']).items())['a'], '12345')
+
+        r, queries = self._session_queries(self.client.get, '/get/')
+        self.assertEqual(queries, [])
+        self.assertEqual(r.json()['a'], '12345')
+
+        r = self.client.post('/set/', {'a': 'abcde'})
+        self.assertNotEqual(self._fields(r)['sv'], fields['sv'])
+
+    def test_nested(self):
+        "Test changes to nested values that were not saved are not served"
+        store = tiered.SessionStore()
+        store['cart'] = ['1']
+        store.save()
+
+        def load():
+            loaded = tiered.SessionStore(store.session_key)
+            loaded.set_jwt_claims({'sv': store.version})
+            return loaded
+
+        with self.assertNumQueries(0):
+            load()['cart'].append('2')
+            self.assertEqual(load()['cart'], ['1'])
+
+    def test_concurrent_saves(self):
+        "Test saves of the same version get distinct versions"
+        store = tiered.SessionStore()
+        store['a'] = '12345'
+        store.save()
+        first = tiered.SessionStore(store.session_key)
+        second = tiered.SessionStore(store.session_key)
+        first['a'], second['a'] = 'abcde', 'fghij'
+        first.save()
+        second.save()
+        self.assertNotEqual(first.version, second.version)
+
+    def test_stale(self):
+        "Test a newer version in the JWT reads the shared backend"
+        self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        fields = self._fields(self.client.post('/set/', {'a': '12345'}))
+
+        # Another process saves the session.
+        other = tiered.SessionStore(fields['sk'])
+        other['a'] = 'abcde'
+        with mock.patch.object(tiered.SessionStore, 'local', LRUCache(10)):
+            other.save()
+        self.assertNotEqual(other.version, fields['sv'])
+        claims = dict(fields.raw, sv=other.version)
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.create_jwt(
+            self.user, fields['sk'], fields=claims)
+
+        r, queries = self._session_queries(self.client.get, '/get/')
+        self.assertNotEqual(queries, [])
+        self.assertEqual(r.json()['a'], 'abcde')
+
+    def test_no_version(self):
+        "Test JWTs without a version read the shared backend"
+        self.client.login(username='john', password='password')
+        self.assertNotIn('sv', session.verify_jwt(
+            self.client.cookies[settings.SESSION_COOKIE_NAME].value))
+        r, queries = self._session_queries(self.client.get, '/get/')
+        self.assertNotEqual(queries, [])
+        self.assertIn('_auth_user_id', r.json())
+
+    def test_delete(self):
+        "Test deleted sessions are dropped from both tiers"
+        self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        fields = self._fields(self.client.post('/set/', {'a': '12345'}))
+        tiered.SessionStore().delete(fields['sk'])
+        self.assertIsNone(tiered.SessionStore.local.get(fields['sk']))
+        self.assertFalse(SessionStore().exists(fields['sk']))
+
+
+class BypassTestCase(SessionHelpersMixin, BaseTestCase):
+    """
+    Test requests that skip JWT handling.
+    """
+
+    def setUp(self):
+        super(BypassTestCase, self).setUp()
+        self._patch_session(BYPASS=session._parse_bypass(['/health'], [r'/hooks/\w+/$']))
+        self.client.login(username='john', password='password')
+
+    def _request(self, path, view=views.set):
+        request = RequestFactory().post(path, {'a': '12345'})
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = \
+            self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        with mock.patch.object(session, 'verify_jwt', wraps=session.verify_jwt) as verify:
+            r = session.SessionMiddleware(view)(request)
+        return request, r, verify.called
+
+    def test_matcher(self):
+        "Test prefixes and patterns"
+        bypass = session._parse_bypass(['/static/', '/health'], [r'/hooks/\w+/$'])
+        self.assertTrue(bypass('/static/app.css'))
+        self.assertTrue(bypass('/healthz'))
+        self.assertTrue(bypass('/hooks/github/'))
+        self.assertFalse(bypass('/hooks/github/x'))
+        self.assertFalse(bypass('/login/'))
+        self.assertIsNone(session._parse_bypass([], []))
+
+    def test_bypass(self):
+        "Test matching requests are not verified, saved or reissued"
+        for path in ('/health', '/hooks/github/'):
+            request, r, verified = self._request(path)
+            self.assertFalse(verified)
+            self.assertIsInstance(request.session, session.BypassSession)
+            self.assertNotIn(settings.SESSION_COOKIE_NAME, r.cookies)
+            self.assertFalse(r.has_header('Vary'))
+
+    def test_other(self):
+        "Test other requests are handled as usual"
+        _, r, verified = self._request('/set/')
+        self.assertTrue(verified)
+        self.assertIn(settings.SESSION_COOKIE_NAME, r.cookies)
+
+    @skipUnless(ASYNC, 'requires Django 3.1+')
+    def test_async(self):
+        "Test the async middleware bypasses matching requests"
+        async def handler(request):
+            return await sync_to_async(views.set)(request)
+
+        request = RequestFactory().post('/health', {'a': '12345'})
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = \
+            self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        r = async_to_sync(AsyncSessionMiddleware(handler))(request)
+        self.assertIsInstance(request.session, session.BypassSession)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, r.cookies)
+
 
 class ViewTestCase(BaseTestCase):
     """
@@ -106,6 +1528,53 @@ class ViewTestCase(BaseTestCase):
         expires = int(time.mktime(datetime.strptime(expires, '%a, %d %b %Y %H:%M:%S %Z').timetuple()))
         self.assertGreater(expires, fields['exp'])
 
+    def test_existing_session(self):
+        "Test sessions saved without the middleware can still be read"
+        store = SessionStore()
+        store['a'] = '12345'
+        store.save()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.create_jwt(
+            self.user, store.session_key)
+        r = self.client.get('/get/')
+        self.assertEqual(r.json()['a'], '12345')
+
+    def test_claims_not_persisted(self):
+        "Test JWT fields are visible in the session without saving it"
+        r = self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        self.assertEqual(r.status_code, 200)
+        sk = session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)['sk']
+
+        with mock.patch.object(SessionStore, 'save') as save:
+            r = self.client.get('/claims/')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()['username'], 'john')
+        save.assert_not_called()
+        self.assertIsNone(r.cookies.get(settings.SESSION_COOKIE_NAME))
+        self.assertNotIn('jwt', SessionStore(sk).load())
+
+    def test_zero_queries(self):
+        "Test requests that do not reissue the JWT make no queries"
+        self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        with self.assertNumQueries(0):
+            r = self.client.get('/claims/')
+        self.assertEqual(r.json()['username'], 'john')
+
+        # Anonymous (from Django's perspective) request with a JWT.
+        client = BaseClient()
+        client.cookies[settings.SESSION_COOKIE_NAME] = session.create_jwt(
+            self.user, 'abcdef123456')
+        with self.assertNumQueries(0):
+            r = client.get('/claims/')
+        self.assertEqual(r.json()['username'], 'john')
+
+    def test_logout(self):
+        "Test JWT fields are dropped when the session is flushed"
+        self.client.post('/login/', {'username': 'john', 'password': 'password'})
+        r = self.client.post('/logout/')
+        self.assertEqual(r.status_code, 200)
+        fields = session.verify_jwt(r.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertNotIn('user_id', fields)
+
     def test_anonymous_session(self):
         "Test anonymous session"
         client = BaseClient()
@@ -147,3 +1616,83 @@ class TestClientTestCase(BaseTestCase):
         self.assertTrue('e' in fields)        # short form
         self.assertTrue('email' in fields)    # long form
         self.assertTrue('foo' in fields)      # from callable
+
+    def test_force_login(self):
+        "Test Client.force_login() sets a JWT"
+        self.client.force_login(self.user)
+        fields = session.verify_jwt(self.client.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertEqual(fields['username'], 'john')
+        self.assertEqual(self.client.session['_auth_user_id'], str(self.user.pk))
+
+    def test_login_relations(self):
+        "Test the user is fetched again only to join relations FIELDS traverse"
+        with mock.patch.object(session, 'user_queryset', return_value=User.objects.all()) \
+                as queryset:
+            self.client.force_login(self.user)
+            queryset.assert_not_called()
+
+            with mock.patch.object(session, '_user_select_related', return_value=['x']):
+                self.client.force_login(self.user)
+            queryset.assert_called_once_with()
+
+    def test_cached_session(self):
+        "Test CachedClient verifies and loads the session once per cookie"
+        client = CachedClient()
+        client.force_login(self.user)
+        with mock.patch('django_session_jwt.test.verify_jwt', wraps=session.verify_jwt) as verify:
+            s = client.session
+            s['a'] = '12345'
+            s.save()
+            self.assertIs(client.session, s)
+            self.assertEqual(verify.call_count, 1)
+
+            self.assertEqual(client.get('/get/').json()['a'], '12345')
+            self.assertIsNot(client.session, s)
+            self.assertEqual(verify.call_count, 2)
+
+
+class TokenFactoryTestCase(BaseTestCase):
+    """
+    Test minting JWTs for synthetic users.
+    """
+
+    def test_tokens(self):
+        "Test valid, expired and tampered JWTs are minted without queries"
+        factory = TokenFactory(extra={'foo': 'bar'}, chunk_size=7)
+        with self.assertNumQueries(0):
+            valid = factory.valid(20, start=100)
+            expired = factory.expired(5)
+            tampered = factory.tampered(5)
+
+        self.assertEqual(len(set(sk for _, sk, _ in valid)), 20)
+        user, sk, blob = valid[0]
+        fields = session.verify_jwt(blob)
+        self.assertEqual(fields['sk'], sk)
+        self.assertEqual(fields['user_id'], 100)
+        self.assertEqual(fields['username'], 'user100')
+        self.assertEqual(fields['foo'], 'bar')
+        self.assertEqual(user.pk, 100)
+
+        for _, _, blob in expired + tampered:
+            self.assertEqual(session.verify_jwt(blob), {})
+        self.assertEqual(pyjwt.decode(
+            expired[0][2], options={'verify_signature': False})['u'], 'user1')
+
+    def test_executor(self):
+        "Test signing in worker processes"
+        with ProcessPoolExecutor(2) as executor:
+            tokens = TokenFactory(executor=executor, chunk_size=10).valid(25)
+        self.assertEqual(
+            [session.verify_jwt(blob)['user_id'] for _, _, blob in tokens],
+            list(range(1, 26)))
+
+    def test_harness(self):
+        "Test driving the middleware with many sessions"
+        harness = LoadHarness(
+            views.set, tasks=[(3, 'get', '/set/', None), (1, 'post', '/set/', {'a': '1'})],
+            seed=1)
+        result = harness.run(users=200, requests=500)
+        self.assertEqual(result['requests'], 500)
+        self.assertEqual(result['errors'], 0)
+        self.assertGreater(result['rps'], 0)
+        self.assertLessEqual(result['p50'], result['p99'])
@@ -2,7 +2,7 @@ from __future__ import unicode_literals
 
 from django.conf.urls import url
 
-from django_session_jwt.views import login, logout, set, get
+from django_session_jwt.views import login, logout, set, get, claims, user
 
 
 urlpatterns = [
@@ -10,5 +10,7 @@ urlpatterns = [
     url(r'^logout/$', logout, name='logout'),
     url(r'^set/$', set, name='set'),
     url(r'^get/$', get, name='get'),
+    url(r'^claims/$', claims, name='claims'),
+    url(r'^user/$', user, name='user'),
 ]
 
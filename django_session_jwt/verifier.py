@@ -0,0 +1,201 @@
+"""
+Verify session JWTs without Django.
+
+Services that only consume the session JWT can use the same verification
+path as the middleware (key loading, short / long field names, the verified
+token cache and revocation checks) without importing or configuring Django:
+
+    from django_session_jwt.verifier import Verifier
+
+    verifier = Verifier.from_config(
+        key=('/etc/keys/rsa', '/etc/keys/rsa.pub'),
+        fields=[('id', 'id', 'user_id'), ('username', 'u', 'username')],
+        cache_size=10000)
+
+    claims = verifier.verify(request.cookies['sessionid'])
+    if claims:
+        user_id = claims['user_id']
+"""
+import hashlib
+
+from timeit import default_timer as timer
+
+import jwt
+from jwt.exceptions import DecodeError, ExpiredSignatureError, InvalidTokenError
+
+from django_session_jwt.batch import portable_key
+from django_session_jwt.cache import LRUCache
+from django_session_jwt.claims import Claims, fields_index, parse_fields
+from django_session_jwt.compact import CompactJWT, SUPPORTED as COMPACT_SUPPORTED
+from django_session_jwt.keys import KeyRing, parse_key
+
+
+# Decodes compressed and plain JWTs alike.
+_JWT = CompactJWT() if COMPACT_SUPPORTED else jwt
+
+
+class Verifier(object):
+    """
+    Verify JWTs and return their claims.
+
+    pubkey and algo are a prepared verification key and its algorithm (see
+    django_session_jwt.keys.parse_key()). Tokens with a "kid" header are
+    verified with the matching key from keyring instead. index maps long field
+    names to short names. Verified claims are kept in cache (an LRUCache) when
+    given. Tokens whose revocation_claim is in revocations (any container,
+    such as a RevocationList) are rejected. metrics is called as
+    metrics(event, duration) like DJANGO_SESSION_JWT["METRICS"].
+
+    With a shared_cache (a SharedCache), the signatures of JWTs verified by
+    any process on the host are not checked again, only their expiry.
+    """
+
+    def __init__(self, pubkey, algo, keyring=None, index=None, cache=None,
+                 revocations=None, revocation_claim='sk', metrics=None,
+                 shared_cache=None):
+        self.pubkey = pubkey
+        self.algo = algo
+        self.keyring = keyring
+        self.index = index or {}
+        self.cache = cache
+        self.revocations = revocations
+        self.revocation_claim = revocation_claim
+        self.metrics = metrics
+        self.shared_cache = shared_cache
+        self._cache_key = None
+        self._fingerprints = {}
+
+    @classmethod
+    def from_config(cls, key, algo=None, keys=None, fields=(), cache_size=0,
+                    session_field='sk', **kwargs):
+        """
+        Build a Verifier from settings in the DJANGO_SESSION_JWT format: key,
+        algo, keys ({kid: key}), fields and cache_size mirror KEY, ALGO, KEYS,
+        FIELDS and CACHE_SIZE. Other arguments are passed to Verifier().
+        """
+        _, pubkey, algo = parse_key(key, algo)
+        return cls(
+            pubkey, algo, keyring=KeyRing(keys) if keys else None,
+            index=fields_index(parse_fields(fields, session_field)),
+            cache=LRUCache(cache_size) if cache_size else None, **kwargs)
+
+    def _emit(self, event, start=None):
+        self.metrics(event, None if start is None else timer() - start)
+
+    def clear_cache(self):
+        "Drop all verified tokens from the cache."
+        if self.cache is not None:
+            self.cache.clear()
+        self._cache_key = (
+            self.pubkey, self.algo, self.keyring.version if self.keyring else 0)
+
+    def verification_key(self, blob):
+        "Return (pubkey, algo) for the kid named in the JWT header, if any."
+        if not self.keyring:
+            return self.pubkey, self.algo
+
+        kid = jwt.get_unverified_header(blob).get('kid')
+        if kid is None:
+            return self.pubkey, self.algo
+
+        key = self.keyring.get(kid)
+        if key is None:
+            raise DecodeError('Unknown key id')
+        return key
+
+    def fingerprint(self, key, algo):
+        "Return a digest identifying a verification key."
+        # Asymmetric key objects are not hashable, index them by id. Keeping a
+        # reference to the key means its id is not reused for another key.
+        try:
+            return self._fingerprints[id(key), algo][1]
+
+        except KeyError:
+            material = portable_key(key)
+            if not isinstance(material, bytes):
+                material = str(material).encode('utf-8')
+            fingerprint = hashlib.sha256(algo.encode('ascii') + b':' + material).digest()
+            self._fingerprints[id(key), algo] = (key, fingerprint)
+            return fingerprint
+
+    def _decode(self, blob, key, algo):
+        "Decode blob, returning the claims and whether the shared cache had it."
+        shared = self.shared_cache
+        if shared is None:
+            return _JWT.decode(blob, key, algorithms=[algo]), False
+
+        digest = shared.digest(self.fingerprint(key, algo), blob)
+        if shared.get(digest):
+            # Verified by some process already, the claims may have expired since.
+            return _JWT.decode(
+                blob, algorithms=[algo],
+                options={'verify_signature': False, 'verify_exp': True}), True
+
+        fields = _JWT.decode(blob, key, algorithms=[algo])
+        shared.set(digest, fields.get('exp'))
+        return fields, False
+
+    def is_revoked(self, fields):
+        return self.revocations is not None and \
+            fields.get(self.revocation_claim) in self.revocations
+
+    def verify(self, blob):
+        """
+        Verify a JWT and return its claims, or {} if it is invalid.
+
+        The claims are a read-only Claims mapping, which also answers to the
+        long names in index.
+        """
+        if not blob:
+            return {}
+
+        cache, metrics = self.cache, self.metrics
+        digest = None
+        if cache is not None and cache.maxsize > 0:
+            if self._cache_key != (
+                    self.pubkey, self.algo,
+                    self.keyring.version if self.keyring else 0):
+                # Verification key changed, cached claims are no longer trusted.
+                self.clear_cache()
+
+            digest = hashlib.sha256(blob.encode('utf-8')).digest()
+            fields = cache.get(digest)
+            if fields is not None:
+                if self.is_revoked(fields):
+                    if metrics:
+                        self._emit('verify.revoked')
+                    return {}
+                if metrics:
+                    self._emit('verify.cached')
+                return fields
+
+        start = metrics and timer()
+        try:
+            key, algo = self.verification_key(blob)
+            fields, shared = self._decode(blob, key, algo)
+
+        except ExpiredSignatureError:
+            if metrics:
+                self._emit('verify.expired', start)
+            return {}
+
+        except InvalidTokenError:
+            if metrics:
+                self._emit('verify.invalid', start)
+            return {}
+
+        if self.is_revoked(fields):
+            if metrics:
+                self._emit('verify.revoked', start)
+            return {}
+
+        if metrics:
+            self._emit('verify.shared' if shared else 'verify.ok', start)
+
+        fields = Claims(fields, self.index)
+
+        if digest is not None:
+            # Claims are read-only, so callers can share the cached instance.
+            cache.set(digest, fields, fields.get('exp'))
+
+        return fields
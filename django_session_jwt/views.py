@@ -31,3 +31,14 @@ def set(request):
 def get(request):
     data = dict(request.session.items())
     return JsonResponse(data)
+
+
+def claims(request):
+    return JsonResponse(dict(request.session.get('jwt', {})))
+
+
+def user(request):
+    return JsonResponse({
+        'username': request.user.get_username(),
+        'email': request.user.email,
+    })